@@ -0,0 +1,89 @@
+"""
+/* Copyright (c) 2022 Amazon
+   Written by Jan Buethe and Jean-Marc Valin */
+/*
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+   OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+*/
+"""
+
+import os
+import time
+import argparse
+
+parser = argparse.ArgumentParser(description='Measure the throughput of the RDOVAE FEC encoder and decoder')
+
+parser.add_argument('--checkpoint', type=str, help='model checkpoint, default: randomly initialized model')
+parser.add_argument('--mode', type=str, choices=['eager', 'trace', 'compile'], nargs='+', help='inference modes to compare, default: eager trace', default=['eager', 'trace'])
+parser.add_argument('--threads', type=int, nargs='+', help='numbers of threads to test, default: 1 2 4', default=[1, 2, 4])
+parser.add_argument('--num-redundancy-frames', default=52, type=int, help='number of redundancy frames per packet (default 52)')
+parser.add_argument('--num-frames', default=500, type=int, help='number of 20 ms frames per encoder call (default 500)')
+parser.add_argument('--iterations', default=5, type=int, help='number of timed iterations (default 5)')
+
+args = parser.parse_args()
+
+os.environ['CUDA_VISIBLE_DEVICES'] = ""
+
+import torch
+
+from rdovae import RDOVAE, inference_modules
+
+
+if args.checkpoint is not None:
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    model = RDOVAE(*checkpoint['model_args'], **checkpoint['model_kwargs'])
+    model.load_state_dict(checkpoint['state_dict'], strict=False)
+else:
+    model = RDOVAE(20, 80, 16, 256, 256)
+
+packet_latents = args.num_redundancy_frames // 2
+num_packets = args.num_frames - 2 * packet_latents + 2
+if num_packets < 1:
+    raise ValueError(f"need at least {args.num_redundancy_frames - 1} frames for a packet of {args.num_redundancy_frames} frames")
+
+features = torch.randn((1, 2 * args.num_frames, model.feature_dim))
+q_ids = torch.arange(packet_latents, dtype=torch.long) % model.quant_levels
+
+
+def frames_per_second(function, frames):
+    # first call is a warm-up (tracing/compilation, allocations)
+    function()
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        function()
+    return args.iterations * frames / (time.perf_counter() - start)
+
+
+print(f"{args.num_frames} frames per encoder call, {num_packets} packets of {args.num_redundancy_frames} frames per decoder call")
+print(f"{'mode':>8} {'threads':>8} {'encoder frames/s':>18} {'decoder packets/s':>18}")
+
+with torch.no_grad():
+    for mode in args.mode:
+        encoder, decoder = inference_modules(model, mode=mode, num_redundancy_frames=args.num_redundancy_frames, num_frames=args.num_frames)
+        zq, states, _ = encoder(features, q_ids)
+
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            encoder_fps = frames_per_second(lambda: encoder(features, q_ids), args.num_frames)
+            decoder_pps = frames_per_second(lambda: decoder(zq[0], q_ids, states[0]), num_packets)
+            print(f"{mode:>8} {threads:>8} {encoder_fps:>18.1f} {decoder_pps:>18.1f}")
@@ -42,26 +42,22 @@ import torch
 import numpy as np
 
 from rdovae import RDOVAE
+from rdovae.entropy_coding import dred_statistics
 from wexchange.torch import dump_torch_weights
 from wexchange.c_export import CWriter, print_vector
 
 
 def dump_statistical_model(writer, qembedding):
-    w = qembedding.weight.detach()
-    levels, dim = w.shape
+    levels, dim = qembedding.weight.shape
     N = dim // 6
 
     print("printing statistical model")
-    quant_scales    = torch.nn.functional.softplus(w[:, : N]).numpy()
-    dead_zone       = 0.05 * torch.nn.functional.softplus(w[:, N : 2 * N]).numpy()
-    r               = torch.sigmoid(w[:, 5 * N : 6 * N]).numpy()
-    p0              = torch.sigmoid(w[:, 4 * N : 5 * N]).numpy()
-    p0              = 1 - r ** (0.5 + 0.5 * p0)
-
-    quant_scales_q8 = np.round(quant_scales * 2**8).astype(np.uint16)
-    dead_zone_q10   = np.round(dead_zone * 2**10).astype(np.uint16)
-    r_q15           = np.round(r * 2**15).astype(np.uint16)
-    p0_q15          = np.round(p0 * 2**15).astype(np.uint16)
+    # same tables as used by the python packet coder (rdovae.entropy_coding)
+    stats = dred_statistics(qembedding.weight)
+    quant_scales_q8 = stats['quant_scales_q8']
+    dead_zone_q10   = stats['dead_zone_q10']
+    r_q15           = stats['r_q15']
+    p0_q15          = stats['p0_q15']
 
     print_vector(writer.source, quant_scales_q8, 'dred_quant_scales_q8', dtype='opus_uint16', static=False)
     print_vector(writer.source, dead_zone_q10, 'dred_dead_zone_q10', dtype='opus_uint16', static=False)
@@ -102,13 +98,13 @@ f"""
         
     # encoder
     encoder_dense_layers = [
-        ('core_encoder.module.dense_1'       , 'enc_dense1',   'TANH'), 
-        ('core_encoder.module.dense_2'       , 'enc_dense3',   'TANH'),
-        ('core_encoder.module.dense_3'       , 'enc_dense5',   'TANH'),
-        ('core_encoder.module.dense_4'       , 'enc_dense7',   'TANH'),
-        ('core_encoder.module.dense_5'       , 'enc_dense8',   'TANH'),
-        ('core_encoder.module.state_dense_1' , 'gdense1'    ,   'TANH'),
-        ('core_encoder.module.state_dense_2' , 'gdense2'    ,   'TANH')
+        ('core_encoder.dense_1'       , 'enc_dense1',   'TANH'), 
+        ('core_encoder.dense_2'       , 'enc_dense3',   'TANH'),
+        ('core_encoder.dense_3'       , 'enc_dense5',   'TANH'),
+        ('core_encoder.dense_4'       , 'enc_dense7',   'TANH'),
+        ('core_encoder.dense_5'       , 'enc_dense8',   'TANH'),
+        ('core_encoder.state_dense_1' , 'gdense1'    ,   'TANH'),
+        ('core_encoder.state_dense_2' , 'gdense2'    ,   'TANH')
     ]
     
     for name, export_name, activation in encoder_dense_layers:
@@ -117,9 +113,9 @@ f"""
   
   
     encoder_gru_layers = [    
-        ('core_encoder.module.gru_1'         , 'enc_dense2',   'TANH'),
-        ('core_encoder.module.gru_2'         , 'enc_dense4',   'TANH'),
-        ('core_encoder.module.gru_3'         , 'enc_dense6',   'TANH')
+        ('core_encoder.gru_1'         , 'enc_dense2',   'TANH'),
+        ('core_encoder.gru_2'         , 'enc_dense4',   'TANH'),
+        ('core_encoder.gru_3'         , 'enc_dense6',   'TANH')
     ]
  
     enc_max_rnn_units = max([dump_torch_weights(enc_writer, model.get_submodule(name), export_name, activation, verbose=True, input_sparse=True, dotp=True)
@@ -127,7 +123,7 @@ f"""
  
     
     encoder_conv_layers = [   
-        ('core_encoder.module.conv1'         , 'bits_dense' ,   'LINEAR') 
+        ('core_encoder.conv1'         , 'bits_dense' ,   'LINEAR') 
     ]
     
     enc_max_conv_inputs = max([dump_torch_weights(enc_writer, model.get_submodule(name), export_name, activation, verbose=True) for name, export_name, activation in encoder_conv_layers])    
@@ -137,15 +133,15 @@ f"""
     
     # decoder
     decoder_dense_layers = [
-        ('core_decoder.module.gru_1_init'    , 'state1',        'TANH'),
-        ('core_decoder.module.gru_2_init'    , 'state2',        'TANH'),
-        ('core_decoder.module.gru_3_init'    , 'state3',        'TANH'),
-        ('core_decoder.module.dense_1'       , 'dec_dense1',    'TANH'),
-        ('core_decoder.module.dense_2'       , 'dec_dense3',    'TANH'),
-        ('core_decoder.module.dense_3'       , 'dec_dense5',    'TANH'),
-        ('core_decoder.module.dense_4'       , 'dec_dense7',    'TANH'),
-        ('core_decoder.module.dense_5'       , 'dec_dense8',    'TANH'),
-        ('core_decoder.module.output'        , 'dec_final',     'LINEAR')
+        ('core_decoder.gru_1_init'    , 'state1',        'TANH'),
+        ('core_decoder.gru_2_init'    , 'state2',        'TANH'),
+        ('core_decoder.gru_3_init'    , 'state3',        'TANH'),
+        ('core_decoder.dense_1'       , 'dec_dense1',    'TANH'),
+        ('core_decoder.dense_2'       , 'dec_dense3',    'TANH'),
+        ('core_decoder.dense_3'       , 'dec_dense5',    'TANH'),
+        ('core_decoder.dense_4'       , 'dec_dense7',    'TANH'),
+        ('core_decoder.dense_5'       , 'dec_dense8',    'TANH'),
+        ('core_decoder.output'        , 'dec_final',     'LINEAR')
     ]
 
     for name, export_name, activation in decoder_dense_layers:
@@ -154,9 +150,9 @@ f"""
         
 
     decoder_gru_layers = [
-        ('core_decoder.module.gru_1'         , 'dec_dense2',    'TANH'),
-        ('core_decoder.module.gru_2'         , 'dec_dense4',    'TANH'),
-        ('core_decoder.module.gru_3'         , 'dec_dense6',    'TANH')
+        ('core_decoder.gru_1'         , 'dec_dense2',    'TANH'),
+        ('core_decoder.gru_2'         , 'dec_dense4',    'TANH'),
+        ('core_decoder.gru_3'         , 'dec_dense6',    'TANH')
     ]
     
     dec_max_rnn_units = max([dump_torch_weights(dec_writer, model.get_submodule(name), export_name, activation, verbose=True, input_sparse=True, dotp=True)
@@ -200,30 +196,30 @@ f"""
 def numpy_export(args, model):
     
     exchange_name_to_name = {
-        'encoder_stack_layer1_dense'    : 'core_encoder.module.dense_1',
-        'encoder_stack_layer3_dense'    : 'core_encoder.module.dense_2',
-        'encoder_stack_layer5_dense'    : 'core_encoder.module.dense_3',
-        'encoder_stack_layer7_dense'    : 'core_encoder.module.dense_4',
-        'encoder_stack_layer8_dense'    : 'core_encoder.module.dense_5',
-        'encoder_state_layer1_dense'    : 'core_encoder.module.state_dense_1',
-        'encoder_state_layer2_dense'    : 'core_encoder.module.state_dense_2',
-        'encoder_stack_layer2_gru'      : 'core_encoder.module.gru_1',
-        'encoder_stack_layer4_gru'      : 'core_encoder.module.gru_2',
-        'encoder_stack_layer6_gru'      : 'core_encoder.module.gru_3',
-        'encoder_stack_layer9_conv'     : 'core_encoder.module.conv1',
+        'encoder_stack_layer1_dense'    : 'core_encoder.dense_1',
+        'encoder_stack_layer3_dense'    : 'core_encoder.dense_2',
+        'encoder_stack_layer5_dense'    : 'core_encoder.dense_3',
+        'encoder_stack_layer7_dense'    : 'core_encoder.dense_4',
+        'encoder_stack_layer8_dense'    : 'core_encoder.dense_5',
+        'encoder_state_layer1_dense'    : 'core_encoder.state_dense_1',
+        'encoder_state_layer2_dense'    : 'core_encoder.state_dense_2',
+        'encoder_stack_layer2_gru'      : 'core_encoder.gru_1',
+        'encoder_stack_layer4_gru'      : 'core_encoder.gru_2',
+        'encoder_stack_layer6_gru'      : 'core_encoder.gru_3',
+        'encoder_stack_layer9_conv'     : 'core_encoder.conv1',
         'statistical_model_embedding'   : 'statistical_model.quant_embedding',
-        'decoder_state1_dense'          : 'core_decoder.module.gru_1_init',
-        'decoder_state2_dense'          : 'core_decoder.module.gru_2_init',
-        'decoder_state3_dense'          : 'core_decoder.module.gru_3_init',
-        'decoder_stack_layer1_dense'    : 'core_decoder.module.dense_1',
-        'decoder_stack_layer3_dense'    : 'core_decoder.module.dense_2',
-        'decoder_stack_layer5_dense'    : 'core_decoder.module.dense_3',
-        'decoder_stack_layer7_dense'    : 'core_decoder.module.dense_4',
-        'decoder_stack_layer8_dense'    : 'core_decoder.module.dense_5',
-        'decoder_stack_layer9_dense'    : 'core_decoder.module.output',
-        'decoder_stack_layer2_gru'      : 'core_decoder.module.gru_1',
-        'decoder_stack_layer4_gru'      : 'core_decoder.module.gru_2',
-        'decoder_stack_layer6_gru'      : 'core_decoder.module.gru_3'
+        'decoder_state1_dense'          : 'core_decoder.gru_1_init',
+        'decoder_state2_dense'          : 'core_decoder.gru_2_init',
+        'decoder_state3_dense'          : 'core_decoder.gru_3_init',
+        'decoder_stack_layer1_dense'    : 'core_decoder.dense_1',
+        'decoder_stack_layer3_dense'    : 'core_decoder.dense_2',
+        'decoder_stack_layer5_dense'    : 'core_decoder.dense_3',
+        'decoder_stack_layer7_dense'    : 'core_decoder.dense_4',
+        'decoder_stack_layer8_dense'    : 'core_decoder.dense_5',
+        'decoder_stack_layer9_dense'    : 'core_decoder.output',
+        'decoder_stack_layer2_gru'      : 'core_decoder.gru_1',
+        'decoder_stack_layer4_gru'      : 'core_decoder.gru_2',
+        'decoder_stack_layer6_gru'      : 'core_decoder.gru_3'
     }
     
     name_to_exchange_name = {value : key for key, value in exchange_name_to_name.items()}
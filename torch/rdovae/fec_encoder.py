@@ -28,6 +28,8 @@
 """
 
 import os
+import time
+import math as m
 import subprocess
 import argparse
 
@@ -39,7 +41,7 @@ parser.add_argument('input', metavar='<input signal>', help='audio input (.wav o
 parser.add_argument('checkpoint', metavar='<weights>', help='model checkpoint')
 parser.add_argument('q0', metavar='<quant level 0>', type=int, help='quantization level for most recent frame')
 parser.add_argument('q1', metavar='<quant level 1>', type=int, help='quantization level for oldest frame')
-parser.add_argument('output', type=str, help='output file (will be extended with .fec)')
+parser.add_argument('output', type=str, help='output file (will be extended with .fec, the range coded packets are written to a .bits file)')
 
 parser.add_argument('--dump-data', type=str, default='./dump_data', help='path to dump data executable (default ./dump_data)')
 parser.add_argument('--num-redundancy-frames', default=52, type=int, help='number of redundancy frames per packet (default 52)')
@@ -53,8 +55,10 @@ import numpy as np
 from scipy.io import wavfile
 import torch
 
-from rdovae import RDOVAE
-from packets import write_fec_packets
+from rdovae import RDOVAE, RDOVAEEncoder, RDOVAEDecoder, PacketCoder
+from rdovae.pvq import pvq_codebook_size
+from rdovae.entropy_coding import pvq_pulses
+from packets import write_fec_packets, write_fec_bitstreams
 
 torch.set_num_threads(4)
 
@@ -135,36 +139,46 @@ features = torch.from_numpy(features)
 print("running fec encoder...")
 with torch.no_grad():
 
-    # encoding
-    z, states, state_size = model.encode(features)
-
-
-    # decoder on packet chunks
+    # quantized latents and states of all packets, packet p ends with latent offset + p
+    encoder = RDOVAEEncoder(model).eval()
+    decoder = RDOVAEDecoder(model).eval()
     input_length = args.num_redundancy_frames // 2
     offset = args.num_redundancy_frames - 1
+    first_packet = offset - (2 * input_length - 2)
 
-    packets = []
-    packet_sizes = []
+    zq, states, rates = encoder(features, quant_ids)
+    zq, states, rates = zq[0, first_packet:], states[0, first_packet:], rates[0, first_packet:]
 
-    for i in range(offset, num_frames):
-        print(f"processing frame {i - offset}...")
-        # quantize / unquantize latent vectors
-        zi = torch.clone(z[:, i - 2 * input_length + 2: i + 1 : 2, :])
-        zi, rates = model.quantize(zi, quant_ids)
-        zi = model.unquantize(zi, quant_ids)
-        
-        features = model.decode(zi, states[:, i : i + 1, :])
-        packets.append(features.squeeze(0).numpy())
-        packet_size = 8 * int((torch.sum(rates) + 7 + state_size) / 8)
-        packet_sizes.append(packet_size)
+    state_size = m.log2(pvq_codebook_size(model.state_dim, model.pvq_num_pulses))
+    estimated_sizes = [8 * int((rate + 7 + state_size) / 8) for rate in rates.tolist()]
+
+    # range coding of all packets at once
+    coder = PacketCoder(model)
+    start = time.perf_counter()
+    bitstreams = coder.encode(zq.numpy(), quant_ids.numpy(), pvq_pulses(states.numpy(), model.pvq_num_pulses))
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    zq_decoded, state_pulses = coder.decode(bitstreams, quant_ids.numpy())
+    decode_time = time.perf_counter() - start
+    if not np.array_equal(zq_decoded, zq.numpy().astype(np.int64)):
+        raise RuntimeError("range coder mismatch")
+    print(f"range coded {len(bitstreams)} packets: {len(bitstreams) / encode_time:.1f} packets/s encoding, {len(bitstreams) / decode_time:.1f} packets/s decoding")
+
+    # decoder on all packets at once, from the decoded bitstreams
+    states = torch.from_numpy(state_pulses / np.linalg.norm(state_pulses, axis=-1, keepdims=True)).float()
+    packets = list(decoder(torch.from_numpy(zq_decoded).float(), quant_ids, states).numpy())
+
+    packet_sizes = [8 * len(bitstream) for bitstream in bitstreams]
+    print(f"processed {len(packets)} packets")
 
 
 # write packets
 packet_file = args.output + '.fec' if not args.output.endswith('.fec') else args.output
 write_fec_packets(packet_file, packets, packet_sizes)
+write_fec_bitstreams(packet_file[:-4] + '.bits', bitstreams, quant_ids.numpy())
 
 
-print(f"average redundancy rate: {int(round(sum(packet_sizes) / len(packet_sizes) * 50 / 1000))} kbps")
+print(f"average redundancy rate: {int(round(sum(packet_sizes) / len(packet_sizes) * 50 / 1000))} kbps (estimated: {int(round(sum(estimated_sizes) / len(estimated_sizes) * 50 / 1000))} kbps)")
 
 # assemble features according to loss file
 if args.lossfile != None:
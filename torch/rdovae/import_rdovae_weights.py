@@ -54,30 +54,30 @@ from rdovae import RDOVAE
 from wexchange.torch import load_torch_weights
 
 exchange_name_to_name = {
-    'encoder_stack_layer1_dense'    : 'core_encoder.module.dense_1',
-    'encoder_stack_layer3_dense'    : 'core_encoder.module.dense_2',
-    'encoder_stack_layer5_dense'    : 'core_encoder.module.dense_3',
-    'encoder_stack_layer7_dense'    : 'core_encoder.module.dense_4',
-    'encoder_stack_layer8_dense'    : 'core_encoder.module.dense_5',
-    'encoder_state_layer1_dense'    : 'core_encoder.module.state_dense_1',
-    'encoder_state_layer2_dense'    : 'core_encoder.module.state_dense_2',
-    'encoder_stack_layer2_gru'      : 'core_encoder.module.gru_1',
-    'encoder_stack_layer4_gru'      : 'core_encoder.module.gru_2',
-    'encoder_stack_layer6_gru'      : 'core_encoder.module.gru_3',
-    'encoder_stack_layer9_conv'     : 'core_encoder.module.conv1',
+    'encoder_stack_layer1_dense'    : 'core_encoder.dense_1',
+    'encoder_stack_layer3_dense'    : 'core_encoder.dense_2',
+    'encoder_stack_layer5_dense'    : 'core_encoder.dense_3',
+    'encoder_stack_layer7_dense'    : 'core_encoder.dense_4',
+    'encoder_stack_layer8_dense'    : 'core_encoder.dense_5',
+    'encoder_state_layer1_dense'    : 'core_encoder.state_dense_1',
+    'encoder_state_layer2_dense'    : 'core_encoder.state_dense_2',
+    'encoder_stack_layer2_gru'      : 'core_encoder.gru_1',
+    'encoder_stack_layer4_gru'      : 'core_encoder.gru_2',
+    'encoder_stack_layer6_gru'      : 'core_encoder.gru_3',
+    'encoder_stack_layer9_conv'     : 'core_encoder.conv1',
     'statistical_model_embedding'   : 'statistical_model.quant_embedding',
-    'decoder_state1_dense'          : 'core_decoder.module.gru_1_init',
-    'decoder_state2_dense'          : 'core_decoder.module.gru_2_init',
-    'decoder_state3_dense'          : 'core_decoder.module.gru_3_init',
-    'decoder_stack_layer1_dense'    : 'core_decoder.module.dense_1',
-    'decoder_stack_layer3_dense'    : 'core_decoder.module.dense_2',
-    'decoder_stack_layer5_dense'    : 'core_decoder.module.dense_3',
-    'decoder_stack_layer7_dense'    : 'core_decoder.module.dense_4',
-    'decoder_stack_layer8_dense'    : 'core_decoder.module.dense_5',
-    'decoder_stack_layer9_dense'    : 'core_decoder.module.output',
-    'decoder_stack_layer2_gru'      : 'core_decoder.module.gru_1',
-    'decoder_stack_layer4_gru'      : 'core_decoder.module.gru_2',
-    'decoder_stack_layer6_gru'      : 'core_decoder.module.gru_3'
+    'decoder_state1_dense'          : 'core_decoder.gru_1_init',
+    'decoder_state2_dense'          : 'core_decoder.gru_2_init',
+    'decoder_state3_dense'          : 'core_decoder.gru_3_init',
+    'decoder_stack_layer1_dense'    : 'core_decoder.dense_1',
+    'decoder_stack_layer3_dense'    : 'core_decoder.dense_2',
+    'decoder_stack_layer5_dense'    : 'core_decoder.dense_3',
+    'decoder_stack_layer7_dense'    : 'core_decoder.dense_4',
+    'decoder_stack_layer8_dense'    : 'core_decoder.dense_5',
+    'decoder_stack_layer9_dense'    : 'core_decoder.output',
+    'decoder_stack_layer2_gru'      : 'core_decoder.gru_1',
+    'decoder_stack_layer4_gru'      : 'core_decoder.gru_2',
+    'decoder_stack_layer6_gru'      : 'core_decoder.gru_3'
 }
 
 if __name__ == "__main__":
@@ -1 +1 @@
-from .fec_packets import write_fec_packets, read_fec_packets
\ No newline at end of file
+from .fec_packets import write_fec_packets, read_fec_packets, write_fec_bitstreams, read_fec_bitstreams
\ No newline at end of file
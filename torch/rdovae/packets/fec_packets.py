@@ -105,4 +105,44 @@ def read_fec_packets(filename):
             packet = np.flip(features, axis=-2)
             packets.append(packet)
             
-    return packets
\ No newline at end of file
+    return packets
+
+
+def write_fec_bitstreams(filename, packets, quant_ids):
+    """ writes range coded packets (list of bytes) and the quantization levels of their latents """
+
+    # header (version, header_size, num_packets (int32), num_latents), then the quantization levels
+    version = 1
+    header_size = 10 + 2 * len(quant_ids)
+
+    with open(filename, 'wb') as f:
+
+        f.write(np.int16(version).tobytes())
+        f.write(np.int16(header_size).tobytes())
+        f.write(np.int32(len(packets)).tobytes())
+        f.write(np.int16(len(quant_ids)).tobytes())
+        f.write(np.asarray(quant_ids, dtype=np.int16).tobytes())
+
+        # packets, preceded by their size in bytes
+        for packet in packets:
+            f.write(np.uint16(len(packet)).tobytes())
+            f.write(packet)
+
+
+def read_fec_bitstreams(filename):
+    """ reads range coded packets, returns the list of packets and the quantization levels """
+
+    with open(filename, 'rb') as f:
+
+        version     = np.frombuffer(f.read(2), dtype=np.int16).item()
+        header_size = np.frombuffer(f.read(2), dtype=np.int16).item()
+        num_packets = np.frombuffer(f.read(4), dtype=np.int32).item()
+        num_latents = np.frombuffer(f.read(2), dtype=np.int16).item()
+        quant_ids   = np.frombuffer(f.read(2 * num_latents), dtype=np.int16).astype(np.int64)
+
+        packets = []
+        for i in range(num_packets):
+            size = np.frombuffer(f.read(2), dtype=np.uint16).item()
+            packets.append(f.read(size))
+
+    return packets, quant_ids
@@ -1,2 +1,5 @@
-from .rdovae import RDOVAE, distortion_loss, hard_rate_estimate, soft_rate_estimate
+from .rdovae import RDOVAE, distortion_loss, strip_wrapper_prefixes, hard_rate_estimate, soft_rate_estimate
 from .dataset import RDOVAEDataset
+from .inference import RDOVAEEncoder, RDOVAEDecoder, RateTable, inference_modules
+from .pvq import pvq_codebook_size, pvq_encode, pvq_decode
+from .entropy_coding import PacketCoder, RangeEncoder, RangeDecoder
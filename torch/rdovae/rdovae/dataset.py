@@ -51,15 +51,17 @@ class RDOVAEDataset(torch.utils.data.Dataset):
         if sequence_length % enc_stride:
             raise ValueError(f"RDOVAEDataset.__init__: enc_stride {enc_stride} does not divide sequence length {sequence_length}")
         
-        self.features = np.reshape(np.fromfile(feature_file, dtype=np.float32), (-1, num_features))
-        self.features = self.features[:, :num_used_features]
+        # the file is only memory-mapped, each item reads the used columns of its sequence
+        features = np.memmap(feature_file, dtype=np.float32, mode='r')
+        num_frames = len(features) // num_features
+        self.features = np.reshape(features[:num_frames * num_features], (num_frames, num_features))[:, :num_used_features]
         self.num_sequences = self.features.shape[0] // sequence_length
 
     def __len__(self):
         return self.num_sequences
 
     def __getitem__(self, index):
-        features = self.features[index * self.sequence_length: (index + 1) * self.sequence_length, :]
+        features = np.array(self.features[index * self.sequence_length: (index + 1) * self.sequence_length, :])
         q_ids = np.random.randint(0, self.quant_levels, (1)).astype(np.int64)
         q_ids = np.repeat(q_ids, self.sequence_length // self.enc_stride, axis=0)
         rate_lambda = self.lambda_min * np.exp(q_ids.astype(np.float32) / self.denominator).astype(np.float32)
@@ -0,0 +1,361 @@
+"""
+/* Copyright (c) 2022 Amazon
+   Written by Jan Buethe */
+/*
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+   OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+*/
+"""
+
+""" Range coding of RDOVAE packets
+
+    RangeEncoder and RangeDecoder follow the Opus entropy coder (celt/entenc.c and
+    celt/entdec.c) and run on many independent streams at once: the coder states are
+    arrays with one entry per stream, and every call codes one symbol in each stream
+    selected by a mask. The latents are coded with the Laplace model of the DRED
+    encoder (ec_laplace_encode_p0() with the exported dred_p0_q15 and dred_r_q15
+    tables), the initial state as its PVQ codebook index, in uniform 15-bit digits.
+"""
+
+import math as m
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .pvq import pvq_codebook_size, pvq_encode, pvq_decode
+
+
+EC_SYM_BITS   = 8
+EC_CODE_BITS  = 32
+EC_SYM_MAX    = (1 << EC_SYM_BITS) - 1
+EC_CODE_SHIFT = EC_CODE_BITS - EC_SYM_BITS - 1
+EC_CODE_TOP   = 1 << (EC_CODE_BITS - 1)
+EC_CODE_BOT   = EC_CODE_TOP >> EC_SYM_BITS
+EC_CODE_EXTRA = (EC_CODE_BITS - 2) % EC_SYM_BITS + 1
+
+# bits of the uniformly coded digits of the PVQ state index
+UNIFORM_BITS = 15
+
+
+def dred_statistics(quant_embedding_weight):
+    """ quantized statistical model as exported to C, (quant_levels, latent_dim) arrays """
+
+    w = quant_embedding_weight.detach().cpu()
+    N = w.shape[1] // 6
+
+    quant_scales    = F.softplus(w[:, : N]).numpy()
+    dead_zone       = 0.05 * F.softplus(w[:, N : 2 * N]).numpy()
+    r               = torch.sigmoid(w[:, 5 * N : 6 * N]).numpy()
+    p0              = torch.sigmoid(w[:, 4 * N : 5 * N]).numpy()
+    p0              = 1 - r ** (0.5 + 0.5 * p0)
+
+    return {
+        'quant_scales_q8'   : np.round(quant_scales * 2**8).astype(np.uint16),
+        'dead_zone_q10'     : np.round(dead_zone * 2**10).astype(np.uint16),
+        'r_q15'             : np.round(r * 2**15).astype(np.uint16),
+        'p0_q15'            : np.round(p0 * 2**15).astype(np.uint16)
+    }
+
+
+def laplace_icdf(p0, decay):
+    """ inverse CDFs (15 bits) of the sign and of the magnitude chunks used by ec_laplace_encode_p0() """
+
+    # keep every symbol codable
+    p0 = np.clip(np.asarray(p0, dtype=np.int64), 1, 32766)
+    decay = np.clip(np.asarray(decay, dtype=np.int64), 0, 32767)
+
+    sign_icdf = np.stack([32768 - p0, (32768 - p0) // 2, np.zeros_like(p0)], axis=-1)
+
+    icdf = [np.maximum(7, decay)]
+    for i in range(1, 7):
+        icdf.append(np.maximum(7 - i, (icdf[-1] * decay) >> 15))
+    icdf.append(np.zeros_like(decay))
+
+    return sign_icdf, np.stack(icdf, axis=-1)
+
+
+def pvq_pulses(x, k):
+    """ integer PVQ vectors with k pulses from their L2 normalized versions (as returned by soft_pvq) """
+    x = np.asarray(x, dtype=np.float64)
+    return np.round(k * x / np.sum(np.abs(x), axis=-1, keepdims=True)).astype(np.int64)
+
+
+class RangeEncoder:
+    def __init__(self, num_streams, capacity=256):
+        """ range encoder for num_streams streams """
+
+        self.num_streams = num_streams
+        self.streams = np.arange(num_streams)
+        self.rng  = np.full(num_streams, EC_CODE_TOP, dtype=np.int64)
+        self.val  = np.zeros(num_streams, dtype=np.int64)
+        self.rem  = np.full(num_streams, -1, dtype=np.int64)
+        self.ext  = np.zeros(num_streams, dtype=np.int64)
+        self.offs = np.zeros(num_streams, dtype=np.int64)
+        self.buf  = np.zeros((num_streams, capacity), dtype=np.uint8)
+
+    def _mask(self, mask):
+        return np.ones(self.num_streams, dtype=bool) if mask is None else mask
+
+    def _write(self, mask, byte):
+        streams = self.streams[mask]
+        if len(streams) == 0:
+            return
+        if np.max(self.offs[streams]) >= self.buf.shape[1]:
+            self.buf = np.concatenate([self.buf, np.zeros_like(self.buf)], axis=1)
+        self.buf[streams, self.offs[streams]] = byte[streams] & EC_SYM_MAX
+        self.offs[streams] += 1
+
+    def _carry_out(self, c, mask):
+        # runs of 0xFF are only written once it is known whether a carry propagates into them
+        self.ext[mask & (c == EC_SYM_MAX)] += 1
+        mask = mask & (c != EC_SYM_MAX)
+        carry = c >> EC_SYM_BITS
+        self._write(mask & (self.rem >= 0), self.rem + carry)
+        if np.any(mask & (self.ext > 0)):
+            for i in range(int(np.max(self.ext[mask]))):
+                self._write(mask & (self.ext > i), EC_SYM_MAX + carry)
+        self.ext[mask] = 0
+        self.rem = np.where(mask, c & EC_SYM_MAX, self.rem)
+
+    def _normalize(self, mask):
+        mask = mask & (self.rng <= EC_CODE_BOT)
+        while np.any(mask):
+            self._carry_out(self.val >> EC_CODE_SHIFT, mask)
+            self.val = np.where(mask, (self.val << EC_SYM_BITS) & (EC_CODE_TOP - 1), self.val)
+            self.rng = np.where(mask, self.rng << EC_SYM_BITS, self.rng)
+            mask = mask & (self.rng <= EC_CODE_BOT)
+
+    def encode(self, fl, fh, ft, mask=None):
+        """ codes symbols with cumulative frequencies [fl, fh) out of ft (ec_encode()) """
+        mask = self._mask(mask)
+        fl, fh, ft = (np.asarray(v, dtype=np.int64) for v in (fl, fh, ft))
+        r = self.rng // ft
+        val = np.where(fl > 0, self.val + self.rng - r * (ft - fl), self.val)
+        rng = np.where(fl > 0, r * (fh - fl), self.rng - r * (ft - fh))
+        self.val = np.where(mask, val, self.val)
+        self.rng = np.where(mask, rng, self.rng)
+        self._normalize(mask)
+
+    def encode_icdf16(self, s, icdf, mask=None, ftb=15):
+        """ codes symbols s with inverse CDFs icdf (num_streams, symbols) or (symbols,) (ec_enc_icdf16()) """
+        mask = self._mask(mask)
+        icdf = np.broadcast_to(icdf, (self.num_streams, np.shape(icdf)[-1]))
+        s = np.where(mask, s, 0)
+        r = self.rng >> ftb
+        previous = icdf[self.streams, np.maximum(s - 1, 0)]
+        current = icdf[self.streams, s]
+        val = np.where(s > 0, self.val + self.rng - r * previous, self.val)
+        rng = np.where(s > 0, r * (previous - current), self.rng - r * current)
+        self.val = np.where(mask, val, self.val)
+        self.rng = np.where(mask, rng, self.rng)
+        self._normalize(mask)
+
+    def done(self):
+        """ flushes the coder state, returns the streams as bytes (without trailing zeros, which the decoder infers) """
+
+        # ilog(rng): rng is exactly representable as a float
+        l = EC_CODE_BITS - np.frexp(self.rng.astype(np.float64))[1].astype(np.int64)
+        msk = (EC_CODE_TOP - 1) >> l
+        end = (self.val + msk) & ~msk
+        grow = (end | msk) >= self.val + self.rng
+        l = l + grow
+        msk = np.where(grow, msk >> 1, msk)
+        end = np.where(grow, (self.val + msk) & ~msk, end)
+
+        while np.any(l > 0):
+            mask = l > 0
+            self._carry_out(end >> EC_CODE_SHIFT, mask)
+            end = np.where(mask, (end << EC_SYM_BITS) & (EC_CODE_TOP - 1), end)
+            l = np.where(mask, l - EC_SYM_BITS, l)
+
+        self._carry_out(np.zeros_like(self.val), (self.rem >= 0) | (self.ext > 0))
+
+        return [self.buf[i, : self.offs[i]].tobytes().rstrip(b'\0') for i in range(self.num_streams)]
+
+
+class RangeDecoder:
+    def __init__(self, streams):
+        """ range decoder for a list of byte streams """
+
+        self.num_streams = len(streams)
+        self.streams = np.arange(self.num_streams)
+        self.lengths = np.array([len(stream) for stream in streams], dtype=np.int64)
+        self.buf = np.zeros((self.num_streams, max(1, int(np.max(self.lengths, initial=0)))), dtype=np.int64)
+        for i, stream in enumerate(streams):
+            self.buf[i, : len(stream)] = np.frombuffer(stream, dtype=np.uint8)
+        self.offs = np.zeros(self.num_streams, dtype=np.int64)
+
+        mask = np.ones(self.num_streams, dtype=bool)
+        self.rng = np.full(self.num_streams, 1 << EC_CODE_EXTRA, dtype=np.int64)
+        self.rem = self._read(mask)
+        self.val = self.rng - 1 - (self.rem >> (EC_SYM_BITS - EC_CODE_EXTRA))
+        self.scale = np.ones(self.num_streams, dtype=np.int64)
+        self._normalize(mask)
+
+    def _mask(self, mask):
+        return np.ones(self.num_streams, dtype=bool) if mask is None else mask
+
+    def _read(self, mask):
+        # zeros past the end of the stream
+        byte = self.buf[self.streams, np.minimum(self.offs, self.buf.shape[1] - 1)]
+        byte = np.where(mask & (self.offs < self.lengths), byte, 0)
+        self.offs += mask
+        return byte
+
+    def _normalize(self, mask):
+        mask = mask & (self.rng <= EC_CODE_BOT)
+        while np.any(mask):
+            self.rng = np.where(mask, self.rng << EC_SYM_BITS, self.rng)
+            sym = self.rem
+            self.rem = np.where(mask, self._read(mask), self.rem)
+            sym = ((sym << EC_SYM_BITS) | self.rem) >> (EC_SYM_BITS - EC_CODE_EXTRA)
+            self.val = np.where(mask, ((self.val << EC_SYM_BITS) + (EC_SYM_MAX & ~sym)) & (EC_CODE_TOP - 1), self.val)
+            mask = mask & (self.rng <= EC_CODE_BOT)
+
+    def decode(self, ft, mask=None):
+        """ cumulative frequency of the next symbols out of ft, to be followed by update() (ec_decode()) """
+        mask = self._mask(mask)
+        ft = np.asarray(ft, dtype=np.int64)
+        self.scale = np.where(mask, self.rng // ft, self.scale)
+        s = self.val // self.scale
+        return np.where(mask, ft - np.minimum(s + 1, ft), 0)
+
+    def update(self, fl, fh, ft, mask=None):
+        """ removes the decoded symbols [fl, fh) out of ft (ec_dec_update()) """
+        mask = self._mask(mask)
+        fl, fh, ft = (np.asarray(v, dtype=np.int64) for v in (fl, fh, ft))
+        s = self.scale * (ft - fh)
+        self.val = np.where(mask, self.val - s, self.val)
+        self.rng = np.where(mask, np.where(fl > 0, self.scale * (fh - fl), self.rng - s), self.rng)
+        self._normalize(mask)
+
+    def decode_uniform(self, ft, mask=None):
+        """ symbols coded with encode(s, s + 1, ft) """
+        s = self.decode(ft, mask)
+        self.update(s, s + 1, ft, mask)
+        return s
+
+    def decode_icdf16(self, icdf, mask=None, ftb=15):
+        """ symbols coded with encode_icdf16() (ec_dec_icdf16()) """
+        mask = self._mask(mask)
+        icdf = np.broadcast_to(icdf, (self.num_streams, np.shape(icdf)[-1])).astype(np.int64)
+        r = self.rng >> ftb
+        # icdf is decreasing, the symbol is the number of thresholds above val
+        thresholds = r[:, None] * icdf
+        s = np.sum(self.val[:, None] < thresholds, axis=-1)
+        current = thresholds[self.streams, s]
+        previous = np.where(s > 0, thresholds[self.streams, np.maximum(s - 1, 0)], self.rng)
+        self.val = np.where(mask, self.val - current, self.val)
+        self.rng = np.where(mask, previous - current, self.rng)
+        self._normalize(mask)
+        return np.where(mask, s, 0)
+
+
+def encode_laplace_p0(encoder, value, sign_icdf, icdf, mask=None):
+    """ ec_laplace_encode_p0(): sign (or zero), then the magnitude - 1 in chunks of 7 with escape """
+    mask = encoder._mask(mask)
+    value = np.asarray(value, dtype=np.int64)
+    encoder.encode_icdf16(np.where(value == 0, 0, np.where(value > 0, 1, 2)), sign_icdf, mask)
+    value = np.abs(value) - 1
+    mask = mask & (value >= 0)
+    while np.any(mask):
+        encoder.encode_icdf16(np.clip(value, 0, 7), icdf, mask)
+        value = value - 7
+        mask = mask & (value >= 0)
+
+def decode_laplace_p0(decoder, sign_icdf, icdf, mask=None):
+    """ ec_laplace_decode_p0() """
+    mask = decoder._mask(mask)
+    s = decoder.decode_icdf16(sign_icdf, mask)
+    value = np.ones(decoder.num_streams, dtype=np.int64)
+    mask = mask & (s != 0)
+    while np.any(mask):
+        v = decoder.decode_icdf16(icdf, mask)
+        value += v
+        mask = mask & (v == 7)
+    return np.where(s == 0, 0, np.where(s == 1, value, -value))
+
+
+class PacketCoder:
+    def __init__(self, model):
+        """ coder of FEC packets: PVQ index of the initial state, then the quantized latents,
+            most recent first (in decoding order) """
+
+        stats = dred_statistics(model.statistical_model.quant_embedding.weight)
+        # (quant_levels, latent_dim, 3) and (quant_levels, latent_dim, 8)
+        self.sign_icdf, self.icdf = laplace_icdf(stats['p0_q15'], stats['r_q15'])
+
+        self.latent_dim = model.latent_dim
+        self.state_dim = model.state_dim
+        self.pvq_num_pulses = model.pvq_num_pulses
+
+        # state index in uniform digits, most significant first
+        self.codebook_size = pvq_codebook_size(self.state_dim, self.pvq_num_pulses)
+        self.num_digits = m.ceil((self.codebook_size - 1).bit_length() / UNIFORM_BITS)
+        self.digit_ft = [1 << UNIFORM_BITS] * self.num_digits
+        if self.num_digits > 0:
+            self.digit_ft[0] = ((self.codebook_size - 1) >> (UNIFORM_BITS * (self.num_digits - 1))) + 1
+
+    def _digits(self, indices):
+        shifts = [UNIFORM_BITS * (self.num_digits - 1 - j) for j in range(self.num_digits)]
+        return np.array([[(index >> shift) & ((1 << UNIFORM_BITS) - 1) for shift in shifts] for index in indices], dtype=np.int64).reshape((len(indices), self.num_digits))
+
+    def encode(self, zq, q_ids, state_pulses):
+        """ zq (packets, packet_latents, latent_dim) and state_pulses (packets, state_dim) hold integers,
+            q_ids (packet_latents,), returns one byte string per packet """
+
+        zq = np.asarray(zq).astype(np.int64)
+        q_ids = np.asarray(q_ids)
+        encoder = RangeEncoder(zq.shape[0])
+
+        digits = self._digits([pvq_encode(y) for y in np.asarray(state_pulses).tolist()])
+        for j in range(self.num_digits):
+            encoder.encode(digits[:, j], digits[:, j] + 1, self.digit_ft[j])
+
+        for i in reversed(range(zq.shape[1])):
+            for d in range(self.latent_dim):
+                encode_laplace_p0(encoder, zq[:, i, d], self.sign_icdf[q_ids[i], d], self.icdf[q_ids[i], d])
+
+        return encoder.done()
+
+    def decode(self, packets, q_ids):
+        """ inverse of encode(), returns zq (packets, packet_latents, latent_dim) and state_pulses (packets, state_dim) """
+
+        q_ids = np.asarray(q_ids)
+        decoder = RangeDecoder(packets)
+
+        indices = [0] * len(packets)
+        for j in range(self.num_digits):
+            digits = decoder.decode_uniform(self.digit_ft[j])
+            indices = [(index << UNIFORM_BITS) + int(digit) for index, digit in zip(indices, digits)]
+        if any(index >= self.codebook_size for index in indices):
+            raise ValueError("corrupted packet: PVQ index out of range")
+        state_pulses = np.array([pvq_decode(index, self.state_dim, self.pvq_num_pulses) for index in indices], dtype=np.int64).reshape((len(packets), self.state_dim))
+
+        zq = np.zeros((len(packets), len(q_ids), self.latent_dim), dtype=np.int64)
+        for i in reversed(range(len(q_ids))):
+            for d in range(self.latent_dim):
+                zq[:, i, d] = decode_laplace_p0(decoder, self.sign_icdf[q_ids[i], d], self.icdf[q_ids[i], d])
+
+        return zq, state_pulses
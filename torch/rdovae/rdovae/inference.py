@@ -0,0 +1,195 @@
+"""
+/* Copyright (c) 2022 Amazon
+   Written by Jan Buethe */
+/*
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+   OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+*/
+"""
+
+""" RDOVAE inference modules for FEC packets
+
+    RDOVAEEncoder runs the encoder over a feature sequence and quantizes the latents
+    of all packets at once, RDOVAEDecoder decodes a batch of packets. The statistical
+    model is evaluated once for all quantization levels and stored as buffers, so the
+    modules only contain tensor operations and can be traced (torch.jit.trace) or
+    compiled (torch.compile) for a fixed packet size. Likewise, RateTable gives the
+    bit cost of quantized latents by table lookups.
+"""
+
+import torch
+from torch import nn
+
+from .rdovae import soft_pvq, soft_dead_zone
+
+
+class RateTable(nn.Module):
+    def __init__(self, model, kind='hard', max_symbol=255):
+        """ bit costs of quantized latents, tabulated per quantization level and latent dimension
+
+            The table holds -log2 of the probability of |symbol| = 0 ... max_symbol under the hard
+            (hard_rate_estimate) or soft (soft_rate_estimate) rate model of the statistical model.
+            Larger symbols are extrapolated with the geometric tail (-log2(r) bits per unit).
+        """
+
+        super(RateTable, self).__init__()
+
+        if kind not in ('hard', 'soft'):
+            raise ValueError(f"unknown rate model {kind}")
+
+        self.latent_dim = model.latent_dim
+        self.max_symbol = max_symbol
+
+        with torch.no_grad():
+            stats = model.statistical_model(torch.arange(model.quant_levels, device=model.statistical_model.quant_embedding.weight.device))
+            a = torch.arange(max_symbol + 1, dtype=torch.float32, device=stats['r_hard'].device)
+
+            if kind == 'hard':
+                r = stats['r_hard'].unsqueeze(-1)
+                p0 = 1 - r ** (0.5 + 0.5 * stats['theta_hard'].unsqueeze(-1))
+                bits = torch.where(a == 0,
+                                   - torch.log2(p0 * r ** a + 1e-6),
+                                   - torch.log2(0.5 * (1 - p0) * (1 - r) * r ** (a - 1) + 1e-6))
+            else:
+                r = stats['r_soft'].unsqueeze(-1)
+                bits = - torch.log2((1 - r) / (1 + r) * r ** a + 1e-6)
+
+        # (quant_levels, latent_dim, max_symbol + 1) and (quant_levels, latent_dim)
+        self.register_buffer('bits', bits.detach().clone())
+        self.register_buffer('tail_bits', - torch.log2(r.squeeze(-1)).detach().clone())
+
+    def forward(self, zq, q_ids):
+        """ bits of each latent vector, zq (..., latent_dim) holds integer symbols and q_ids broadcasts to zq.shape[:-1] """
+
+        a = torch.abs(torch.round(zq)).long()
+        clamped = torch.clamp(a, max=self.max_symbol)
+
+        # flat indices into the tables, no per-call expansion of the tables
+        level_dim = q_ids.unsqueeze(-1) * self.latent_dim + torch.arange(self.latent_dim, device=zq.device)
+        bits = self.bits.view(-1)[level_dim * (self.max_symbol + 1) + clamped]
+        bits = bits + (a - clamped) * self.tail_bits.view(-1)[level_dim]
+
+        return torch.sum(bits, dim=-1)
+
+
+class RDOVAEEncoder(nn.Module):
+    def __init__(self, model):
+        """ encoder and latent quantization of a trained RDOVAE """
+
+        super(RDOVAEEncoder, self).__init__()
+
+        self.core_encoder = model.core_encoder
+        self.pvq_num_pulses = model.pvq_num_pulses
+
+        with torch.no_grad():
+            stats = model.statistical_model(torch.arange(model.quant_levels, device=model.statistical_model.quant_embedding.weight.device))
+        self.register_buffer('quant_scale', stats['quant_scale'].detach().clone())
+        self.register_buffer('dead_zone', stats['dead_zone'].detach().clone())
+        self.rate_table = RateTable(model, kind='hard')
+
+    def forward(self, features, q_ids):
+        """ features (batch, frames, feature_dim), q_ids (packet_latents,) in reverse decoding order
+
+            Packet p holds every other latent vector up to latent p + 2 * packet_latents - 2 and
+            the (PVQ quantized) decoder state of that latent. Returns the quantized latents
+            (batch, packets, packet_latents, latent_dim), the states (batch, packets, state_dim)
+            and the estimated rate of the latents of each packet (batch, packets).
+        """
+
+        z, states = self.core_encoder(features)
+        states = soft_pvq(states, self.pvq_num_pulses)
+
+        # sliding windows over the latents, (batch, packets, latent_dim, 2 * packet_latents - 1)
+        window = 2 * q_ids.size(0) - 1
+        z = z.unfold(1, window, 1)[..., ::2].transpose(-1, -2)
+        states = states[:, window - 1:, :]
+
+        zq = z * self.quant_scale[q_ids]
+        zq = soft_dead_zone(zq, self.dead_zone[q_ids])
+        zq = torch.round(zq)
+
+        rates = torch.sum(self.rate_table(zq, q_ids), dim=-1)
+
+        return zq, states, rates
+
+
+class RDOVAEDecoder(nn.Module):
+    def __init__(self, model):
+        """ unquantization and decoder of a trained RDOVAE """
+
+        super(RDOVAEDecoder, self).__init__()
+
+        self.core_decoder = model.core_decoder
+
+        with torch.no_grad():
+            stats = model.statistical_model(torch.arange(model.quant_levels, device=model.statistical_model.quant_embedding.weight.device))
+        self.register_buffer('quant_scale', stats['quant_scale'].detach().clone())
+
+    def forward(self, zq, q_ids, states):
+        """ zq (packets, packet_latents, latent_dim), q_ids (packet_latents,), states (packets, state_dim)
+
+            Returns the decoded features (packets, dec_stride * packet_latents, feature_dim).
+        """
+
+        z = zq / self.quant_scale[q_ids]
+
+        features_reverse = self.core_decoder(torch.flip(z, [1]), states.unsqueeze(1))
+
+        return torch.flip(features_reverse, [1])
+
+
+def inference_modules(model, mode='trace', num_redundancy_frames=52, num_frames=500, num_packets=None):
+    """ encoder and decoder for packets of num_redundancy_frames frames
+
+        mode is 'eager', 'trace' (TorchScript, fixed shapes) or 'compile' (torch.compile, torch >= 2.0).
+        For tracing, the encoder input is num_frames 20 ms frames (2 * num_frames feature frames) and the
+        decoder input num_packets packets (by default the number of packets produced by the encoder).
+    """
+
+    model.eval()
+    encoder = RDOVAEEncoder(model).eval()
+    decoder = RDOVAEDecoder(model).eval()
+
+    if mode == 'eager':
+        return encoder, decoder
+
+    if mode == 'compile':
+        return torch.compile(encoder, dynamic=False), torch.compile(decoder, dynamic=False)
+
+    if mode != 'trace':
+        raise ValueError(f"unknown inference mode {mode}")
+
+    packet_latents = num_redundancy_frames // 2
+    if num_packets is None:
+        num_packets = num_frames - 2 * packet_latents + 2
+
+    q_ids = torch.zeros(packet_latents, dtype=torch.long)
+    features = torch.zeros((1, 2 * num_frames, model.feature_dim))
+    zq = torch.zeros((num_packets, packet_latents, model.latent_dim))
+    states = torch.zeros((num_packets, model.state_dim))
+
+    with torch.no_grad():
+        encoder = torch.jit.trace(encoder, (features, q_ids))
+        decoder = torch.jit.trace(decoder, (zq, q_ids, states))
+
+    return encoder, decoder
@@ -0,0 +1,124 @@
+"""
+/* Copyright (c) 2022 Amazon
+   Written by Jan Buethe */
+/*
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+   OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+*/
+"""
+
+""" Enumeration of pyramid vector quantizer codebooks
+
+    The codebook of dimension n with k pulses holds the integer vectors y with
+    sum(|y|) = k. Its size V(n, k) follows V(n, k) = V(n - 1, k) + V(n, k - 1) + V(n - 1, k - 1)
+    and is computed iteratively for all n' <= n, k' <= k, the tables of the last few
+    (n, k) are kept. Vectors are enumerated position by position: zero first, then
+    increasing magnitudes, positive before negative. The indices are python ints, as
+    codebooks quickly exceed 64 bits.
+"""
+
+import functools
+
+
+@functools.lru_cache(maxsize=16)
+def pvq_table(n, k):
+    """ table V with V[i][j] the size of the codebook of dimension i with j pulses, for i <= n and j <= k """
+
+    if n < 0 or k < 0:
+        raise ValueError(f"invalid PVQ codebook dimension {n} or number of pulses {k}")
+
+    V = [[1] + [0] * k]
+    for i in range(1, n + 1):
+        row = [1]
+        for j in range(1, k + 1):
+            row.append(V[i - 1][j] + row[j - 1] + V[i - 1][j - 1])
+        V.append(row)
+
+    return tuple(tuple(row) for row in V)
+
+
+def pvq_codebook_size(n, k):
+    """ number of integer vectors of dimension n with sum(|y|) = k """
+    return pvq_table(n, k)[n][k]
+
+
+def pvq_encode(y):
+    """ index of the integer vector y in its codebook (of dimension len(y) with sum(|y|) pulses) """
+
+    y = [int(v) for v in y]
+    n = len(y)
+    k = sum(abs(v) for v in y)
+    V = pvq_table(n, k)
+
+    index = 0
+    for i, v in enumerate(y):
+        if k == 0:
+            break
+        rest = V[n - i - 1]
+        a = abs(v)
+        if a > 0:
+            # vectors with a smaller magnitude at this position, then the positive one
+            index += rest[k] + 2 * sum(rest[k - j] for j in range(1, a))
+            if v < 0:
+                index += rest[k - a]
+        k -= a
+
+    return index
+
+
+def pvq_decode(index, n, k):
+    """ integer vector of dimension n with k pulses at position index of the codebook """
+
+    V = pvq_table(n, k)
+    if not 0 <= index < V[n][k]:
+        raise ValueError(f"PVQ index {index} out of range for dimension {n} with {k} pulses")
+
+    y = []
+    for i in range(n):
+        rest = V[n - i - 1]
+        if k == 0 or index < rest[k]:
+            y.append(0)
+            continue
+        index -= rest[k]
+        a = 1
+        while index >= 2 * rest[k - a]:
+            index -= 2 * rest[k - a]
+            a += 1
+        if index >= rest[k - a]:
+            index -= rest[k - a]
+            y.append(-a)
+        else:
+            y.append(a)
+        k -= a
+
+    return y
+
+
+def pvq_encode_batch(y):
+    """ indices of a batch of integer vectors (any nested sequence or tensor of shape (..., n)) """
+
+    if hasattr(y, 'tolist'):
+        y = y.tolist()
+    if len(y) > 0 and isinstance(y[0], (list, tuple)):
+        return [pvq_encode_batch(v) for v in y]
+    return pvq_encode(y)
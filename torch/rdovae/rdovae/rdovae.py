@@ -30,46 +30,60 @@
 """ Pytorch implementations of rate distortion optimized variational autoencoder """
 
 import math as m
+from collections import OrderedDict
 
 import torch
 from torch import nn
 import torch.nn.functional as F
 
+from .pvq import pvq_codebook_size
+
 # Quantization and rate related utily functions
 
+def pvq_search(x, k):
+    """ pyramid vector quantization of x with k pulses
+
+        Returns the integer vector y with ||y||_1 = k (as a tensor of the type of x)
+        that is closest in angle to x: the pulses of the projection of x on the
+        pyramid (rounded down), then the remaining pulses (fewer than the dimension
+        of x) placed one at a time where they increase the correlation the most.
+    """
+
+    n = x.size(-1)
+
+    with torch.no_grad():
+        abs_x = torch.abs(x)
+
+        # all pulses of zero vectors go to the first position
+        first = F.one_hot(torch.zeros(1, dtype=torch.long, device=x.device), n).to(x.dtype)
+        abs_x = abs_x + (torch.sum(abs_x, dim=-1, keepdim=True) == 0).to(x.dtype) * first
+        l1 = torch.sum(abs_x, dim=-1, keepdim=True)
+
+        # projection, slightly shrunk so that rounding errors never give more than k pulses
+        y = torch.floor(k * (1 - 1e-6) * abs_x / l1)
+        remaining = k - torch.sum(y, dim=-1, keepdim=True)
+
+        # greedy placement of the remaining pulses, at most n steps
+        for _ in range(n):
+            xy = torch.sum(abs_x * y, dim=-1, keepdim=True)
+            yy = torch.sum(y * y, dim=-1, keepdim=True)
+            score = (xy + abs_x) ** 2 / (yy + 2 * y + 1)
+            pulse = F.one_hot(torch.argmax(score, dim=-1), n).to(x.dtype) * (remaining > 0).to(x.dtype)
+            y = y + pulse
+            remaining = remaining - torch.sum(pulse, dim=-1, keepdim=True)
+
+        y = torch.where(x < 0, -y, y)
+
+    return y
+
 def soft_pvq(x, k):
     """ soft pyramid vector quantizer """
 
     # L2 normalization
     x_norm2 = x / (1e-15 + torch.norm(x, dim=-1, keepdim=True))
-    
 
-    with torch.no_grad():
-        # quantization loop, no need to track gradients here
-        x_norm1 = x / torch.sum(torch.abs(x), dim=-1, keepdim=True)
-
-        # set initial scaling factor to k
-        scale_factor = k
-        x_scaled = scale_factor * x_norm1
-        x_quant = torch.round(x_scaled)
-
-        # we aim for ||x_quant||_L1 = k
-        for _ in range(10):
-            # remove signs and calculate L1 norm
-            abs_x_quant = torch.abs(x_quant)
-            abs_x_scaled = torch.abs(x_scaled)
-            l1_x_quant = torch.sum(abs_x_quant, axis=-1)
-
-            # increase, where target is too small and decrease, where target is too large
-            plus  = 1.0001 * torch.min((abs_x_quant + 0.5) / (abs_x_scaled + 1e-15), dim=-1).values
-            minus = 0.9999 * torch.max((abs_x_quant - 0.5) / (abs_x_scaled + 1e-15), dim=-1).values
-            factor = torch.where(l1_x_quant > k, minus, plus)
-            factor = torch.where(l1_x_quant == k, torch.ones_like(factor), factor)
-            scale_factor = scale_factor * factor.unsqueeze(-1)
-
-            # update x
-            x_scaled = scale_factor * x_norm1
-            x_quant = torch.round(x_quant)
+    # quantization, no need to track gradients here
+    x_quant = pvq_search(x, k)
 
     # L2 normalization of quantized x
     x_quant_norm2 = x_quant / (1e-15 + torch.norm(x_quant, dim=-1, keepdim=True))
@@ -77,28 +91,6 @@ def soft_pvq(x, k):
 
     return x_norm2 + quantization_error.detach()
 
-def cache_parameters(func):
-    cache = dict()
-    def cached_func(*args):
-        if args in cache:
-            return cache[args]
-        else:
-            cache[args] = func(*args)
-        
-        return cache[args]
-    return cached_func
-        
-@cache_parameters
-def pvq_codebook_size(n, k):
-    
-    if k == 0:
-        return 1
-    
-    if n == 0:
-        return 0
-    
-    return pvq_codebook_size(n - 1, k) + pvq_codebook_size(n, k - 1) + pvq_codebook_size(n - 1, k - 1)
-
 
 def soft_rate_estimate(z, r, reduce=True):
     """ rate approximation with dependent theta Eq. (7)"""
@@ -225,6 +217,17 @@ def weight_clip_factory(max_value):
 # RDOVAE module and submodules
 
 
+def strip_wrapper_prefixes(state_dict):
+    """ removes the 'module.' name components added by nn.DataParallel and DistributedDataParallel """
+    stripped = OrderedDict()
+    for key, value in state_dict.items():
+        key = '.' + key
+        while '.module.' in key:
+            key = key.replace('.module.', '.')
+        stripped[key[1:]] = value
+    return stripped
+
+
 class CoreEncoder(nn.Module):
     STATE_HIDDEN = 128
     FRAMES_PER_STEP = 2
@@ -430,7 +433,8 @@ class RDOVAE(nn.Module):
                  split_mode='split',
                  clip_weights=True,
                  pvq_num_pulses=82,
-                 state_dropout_rate=0):
+                 state_dropout_rate=0,
+                 batched_decoding=True):
 
         super(RDOVAE, self).__init__()
 
@@ -443,11 +447,17 @@ class RDOVAE(nn.Module):
         self.state_dim      = state_dim
         self.pvq_num_pulses = pvq_num_pulses
         self.state_dropout_rate = state_dropout_rate
+        self.batched_decoding = batched_decoding
+
+        # memoized decoder chunk plans ('split' mode only) and their gather indices per device
+        self.chunk_plans = dict()
+        self.chunk_indices = OrderedDict()
+        self.max_cached_chunk_indices = 64
         
         # submodules encoder and decoder share the statistical model
         self.statistical_model = StatisticalModel(quant_levels, latent_dim)
-        self.core_encoder = nn.DataParallel(CoreEncoder(feature_dim, latent_dim, cond_size, cond_size2, state_size=state_dim))
-        self.core_decoder = nn.DataParallel(CoreDecoder(latent_dim, feature_dim, cond_size, cond_size2, state_size=state_dim))
+        self.core_encoder = CoreEncoder(feature_dim, latent_dim, cond_size, cond_size2, state_size=state_dim)
+        self.core_decoder = CoreDecoder(latent_dim, feature_dim, cond_size, cond_size2, state_size=state_dim)
         
         self.enc_stride = CoreEncoder.FRAMES_PER_STEP
         self.dec_stride = CoreDecoder.FRAMES_PER_STEP
@@ -460,11 +470,27 @@ class RDOVAE(nn.Module):
         if self.dec_stride % self.enc_stride != 0:
             raise ValueError(f"get_decoder_chunks_generic: encoder stride does not divide decoder stride")
     
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        """ also accepts state dicts written with nn.DataParallel or DistributedDataParallel wrappers """
+        return super(RDOVAE, self).load_state_dict(strip_wrapper_prefixes(state_dict), *args, **kwargs)
+
     def clip_weights(self):
         if not type(self.weight_clip_fn) == type(None):
             self.apply(self.weight_clip_fn)
             
     def get_decoder_chunks(self, z_frames, mode='split', chunks_per_offset = 4):
+        """ decoder chunks for z_frames latent frames, memoized except in 'random_split' mode """
+
+        if mode == 'random_split':
+            return self.plan_decoder_chunks(z_frames, mode, chunks_per_offset)
+
+        key = (z_frames, mode, chunks_per_offset)
+        if key not in self.chunk_plans:
+            self.chunk_plans[key] = self.plan_decoder_chunks(z_frames, mode, chunks_per_offset)
+
+        return self.chunk_plans[key]
+
+    def plan_decoder_chunks(self, z_frames, mode='split', chunks_per_offset = 4):
         
         enc_stride = self.enc_stride
         dec_stride = self.dec_stride
@@ -513,6 +539,60 @@ class RDOVAE(nn.Module):
         return chunks
 
 
+    def decoder_chunk_indices(self, chunks, device):
+        """ gather indices for decoding all chunks in one batch
+
+            Returns the (num_chunks, max_len) indices of the reversed latent frames of
+            each chunk (padded at the end, which does not affect the valid outputs of
+            the causal decoder), the indices of the initial states, the indices that
+            reverse the first features_stop - features_start decoder outputs of each
+            chunk, and the number of valid outputs per chunk. The indices are cached
+            per chunk layout and device.
+        """
+        key = (tuple((chunk['z_start'], chunk['z_stop'], chunk['z_stride'], chunk['features_start'], chunk['features_stop']) for chunk in chunks), str(device))
+        if key in self.chunk_indices:
+            self.chunk_indices.move_to_end(key)
+            return self.chunk_indices[key]
+
+        lengths = [len(range(chunk['z_start'], chunk['z_stop'], chunk['z_stride'])) for chunk in chunks]
+        max_len = max(lengths)
+        z_index = torch.tensor([[chunk['z_stop'] - 1 - chunk['z_stride'] * min(i, length - 1) for i in range(max_len)]
+                                for chunk, length in zip(chunks, lengths)], dtype=torch.long, device=device)
+        state_index = torch.tensor([chunk['z_stop'] - 1 for chunk in chunks], dtype=torch.long, device=device)
+        num_outputs = [chunk['features_stop'] - chunk['features_start'] for chunk in chunks]
+        output_index = torch.tensor([[max(n - 1 - i, 0) for i in range(max_len * self.dec_stride)] for n in num_outputs], dtype=torch.long, device=device)
+
+        # least recently used entries are dropped (random splits rarely repeat)
+        self.chunk_indices[key] = (z_index, state_index, output_index, num_outputs)
+        if len(self.chunk_indices) > self.max_cached_chunk_indices:
+            self.chunk_indices.popitem(last=False)
+
+        return self.chunk_indices[key]
+
+    def decode_chunks(self, z_q, z_n, states_q, chunks):
+        """ runs the decoder on all chunks, with hard and soft quantized input, in a single batch """
+
+        batch = z_q.size(0)
+        num_chunks = len(chunks)
+        z_index, state_index, output_index, num_outputs = self.decoder_chunk_indices(chunks, z_q.device)
+
+        # (2, num_chunks, batch, max_len, latent_dim) -> (2 * num_chunks * batch, max_len, latent_dim)
+        z_dec_reverse = torch.stack((z_q[:, z_index], z_n[:, z_index])).transpose(1, 2)
+        z_dec_reverse = z_dec_reverse.reshape(-1, z_dec_reverse.size(-2), z_dec_reverse.size(-1))
+        dec_initial_state = states_q[:, state_index].transpose(0, 1).reshape(num_chunks * batch, 1, -1).repeat(2, 1, 1)
+
+        features_reverse = self.core_decoder(z_dec_reverse, dec_initial_state)
+        features_reverse = features_reverse.reshape(2, num_chunks, batch, features_reverse.size(-2), features_reverse.size(-1))
+
+        # undo the reversal for all chunks at once
+        index = output_index[None, :, None, :, None].expand(2, num_chunks, batch, -1, features_reverse.size(-1))
+        features = torch.gather(features_reverse, 3, index)
+
+        outputs_hq = [(features[0, i, :, : num_outputs[i]], chunk['features_start'], chunk['features_stop']) for i, chunk in enumerate(chunks)]
+        outputs_sq = [(features[1, i, :, : num_outputs[i]], chunk['features_start'], chunk['features_stop']) for i, chunk in enumerate(chunks)]
+
+        return outputs_hq, outputs_sq
+
     def forward(self, features, q_id):
 
         # calculate statistical model from quantization ID
@@ -539,20 +619,23 @@ class RDOVAE(nn.Module):
         # decoder
         chunks = self.get_decoder_chunks(z.size(1), mode=self.split_mode)
 
-        outputs_hq = []
-        outputs_sq = []
-        for chunk in chunks:
-            # decoder with hard quantized input
-            z_dec_reverse       = torch.flip(z_q[..., chunk['z_start'] : chunk['z_stop'] : chunk['z_stride'], :], [1])
-            dec_initial_state   = states_q[..., chunk['z_stop'] - 1 : chunk['z_stop'], :]
-            features_reverse = self.core_decoder(z_dec_reverse,  dec_initial_state)
-            outputs_hq.append((torch.flip(features_reverse, [1]), chunk['features_start'], chunk['features_stop']))
-
-
-            # decoder with soft quantized input
-            z_dec_reverse       = torch.flip(z_n[..., chunk['z_start'] : chunk['z_stop'] : chunk['z_stride'], :],  [1])
-            features_reverse    = self.core_decoder(z_dec_reverse, dec_initial_state)
-            outputs_sq.append((torch.flip(features_reverse, [1]), chunk['features_start'], chunk['features_stop']))          
+        if self.batched_decoding:
+            outputs_hq, outputs_sq = self.decode_chunks(z_q, z_n, states_q, chunks)
+        else:
+            outputs_hq = []
+            outputs_sq = []
+            for chunk in chunks:
+                # decoder with hard quantized input
+                z_dec_reverse       = torch.flip(z_q[..., chunk['z_start'] : chunk['z_stop'] : chunk['z_stride'], :], [1])
+                dec_initial_state   = states_q[..., chunk['z_stop'] - 1 : chunk['z_stop'], :]
+                features_reverse = self.core_decoder(z_dec_reverse,  dec_initial_state)
+                outputs_hq.append((torch.flip(features_reverse, [1]), chunk['features_start'], chunk['features_stop']))
+
+
+                # decoder with soft quantized input
+                z_dec_reverse       = torch.flip(z_n[..., chunk['z_start'] : chunk['z_stop'] : chunk['z_stride'], :],  [1])
+                features_reverse    = self.core_decoder(z_dec_reverse, dec_initial_state)
+                outputs_sq.append((torch.flip(features_reverse, [1]), chunk['features_start'], chunk['features_stop']))          
 
         return {
             'outputs_hard_quant' : outputs_hq,
@@ -28,6 +28,7 @@
 """
 
 import os
+import time
 import argparse
 
 import torch
@@ -42,6 +43,7 @@ parser.add_argument('features', type=str, help='path to feature file in .f32 for
 parser.add_argument('output', type=str, help='path to output folder')
 
 parser.add_argument('--cuda-visible-devices', type=str, help="comma separates list of cuda visible device indices, default: ''", default="")
+parser.add_argument('--distributed-backend', type=str, choices=['gloo', 'nccl'], help="torch.distributed backend when launched with torchrun, default: gloo", default='gloo')
 
 
 model_group = parser.add_argument_group(title="model parameters")
@@ -56,7 +58,7 @@ model_group.add_argument('--pvq-num-pulses', type=int, help="number of pulses fo
 model_group.add_argument('--state-dropout-rate', type=float, help="state dropout rate, default: 0", default=0.0)
 
 training_group = parser.add_argument_group(title="training parameters")
-training_group.add_argument('--batch-size', type=int, help="batch size, default: 32", default=32)
+training_group.add_argument('--batch-size', type=int, help="batch size (per process in distributed training), default: 32", default=32)
 training_group.add_argument('--lr', type=float, help='learning rate, default: 3e-4', default=3e-4)
 training_group.add_argument('--epochs', type=int, help='number of training epochs, default: 100', default=100)
 training_group.add_argument('--sequence-length', type=int, help='sequence length, needs to be divisible by 4, default: 256', default=256)
@@ -98,8 +100,21 @@ checkpoint['adam_betas'] = adam_betas
 # logging
 log_interval = 10
 
+# distributed training, one process per device (or CPU socket) started by torchrun
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+rank = int(os.environ.get('RANK', 0))
+local_rank = int(os.environ.get('LOCAL_RANK', 0))
+distributed = world_size > 1
+if distributed:
+    torch.distributed.init_process_group(backend=args.distributed_backend)
+
 # device
-device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+if torch.cuda.is_available():
+    device = torch.device("cuda", local_rank) if distributed else torch.device("cuda")
+    if distributed:
+        torch.cuda.set_device(device)
+else:
+    device = torch.device("cpu")
 
 # model parameters
 cond_size  = args.cond_size
@@ -131,7 +146,7 @@ if args.train_decoder_only:
     if args.initial_checkpoint is None:
         print("warning: training decoder only without providing initial checkpoint")
         
-    for p in model.core_encoder.module.parameters():
+    for p in model.core_encoder.parameters():
         p.requires_grad = False
         
     for p in model.statistical_model.parameters():
@@ -141,7 +156,9 @@ if args.train_decoder_only:
 checkpoint['dataset_args'] = (feature_file, sequence_length, num_features, 36)
 checkpoint['dataset_kwargs'] = {'lambda_min': lambda_min, 'lambda_max': lambda_max, 'enc_stride': model.enc_stride, 'quant_levels': quant_levels}
 dataset = RDOVAEDataset(*checkpoint['dataset_args'], **checkpoint['dataset_kwargs'])
-dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=4)
+# each process sees its own shard of the training data
+sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=True, drop_last=True) if distributed else None
+dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=sampler is None, sampler=sampler, drop_last=True, num_workers=4)
 
 
 
@@ -153,31 +170,58 @@ optimizer = torch.optim.Adam(params, lr=lr, betas=adam_betas, eps=adam_eps)
 # learning rate scheduler
 scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer=optimizer, lr_lambda=lambda x : 1 / (1 + lr_decay_factor * x))
 
+
+class RunningStats:
+    """ running sums of scalar losses, accumulated on the device so that reading them
+        (and syncing with the device) is only needed at log time """
+    def __init__(self, names, device):
+        self.names = names
+        self.sums = torch.zeros(len(names), device=device)
+        self.count = 0
+
+    def update(self, *values):
+        self.sums += torch.stack([value.detach() for value in values])
+        self.count += 1
+
+    def totals(self):
+        return dict(zip(self.names, self.sums.tolist()))
+
+
 if __name__ == '__main__':
 
     # push model to device
     model.to(device)
 
+    # the checkpoints are written from the unwrapped model, so parameter names do not depend on the wrapper
+    if distributed:
+        train_model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[local_rank] if device.type == 'cuda' else None)
+    else:
+        train_model = model
+
     # training loop
 
     for epoch in range(1, epochs + 1):
 
-        print(f"training epoch {epoch}...")
+        if rank == 0:
+            print(f"training epoch {epoch}...")
+
+        if sampler is not None:
+            sampler.set_epoch(epoch)
 
         # running stats
-        running_rate_loss       = 0
-        running_soft_dist_loss  = 0
-        running_hard_dist_loss  = 0
-        running_hard_rate_loss  = 0
-        running_soft_rate_loss  = 0
-        running_total_loss      = 0
-        running_rate_metric     = 0
-        previous_total_loss     = 0
-        running_first_frame_loss = 0
-
-        with tqdm.tqdm(dataloader, unit='batch') as tepoch:
+        running_stats = RunningStats(['total_loss', 'dist_hq', 'dist_sq', 'rate_loss', 'rate', 'ffloss', 'rateloss_hard', 'rateloss_soft'], device)
+        previous_total_loss = 0
+
+        # throughput (feature frames per second in this process) and time spent waiting for the data loader
+        interval_start = time.perf_counter()
+        step_end = interval_start
+        data_wait = 0
+
+        with tqdm.tqdm(dataloader, unit='batch', disable=rank != 0) as tepoch:
             for i, (features, rate_lambda, q_ids) in enumerate(tepoch):
 
+                data_wait += time.perf_counter() - step_end
+
                 # zero out gradients
                 optimizer.zero_grad()
                 
@@ -190,7 +234,7 @@ if __name__ == '__main__':
                 rate_lambda_upsamp = torch.repeat_interleave(rate_lambda, 2, 1)
                 
                 # run model
-                model_output = model(features, q_ids)
+                model_output = train_model(features, q_ids)
 
                 # collect outputs
                 z                   = model_output['z']
@@ -237,34 +281,39 @@ if __name__ == '__main__':
                 
                 scheduler.step()
 
-                # collect running stats
-                running_hard_dist_loss  += float(distortion_loss_hard_quant.detach().cpu())
-                running_soft_dist_loss  += float(distortion_loss_soft_quant.detach().cpu())
-                running_rate_loss       += float(rate_loss.detach().cpu())
-                running_rate_metric     += float(hard_rate_metric.detach().cpu())
-                running_total_loss      += float(total_loss.detach().cpu())
-                running_first_frame_loss += float(first_frame_loss.detach().cpu())
-                running_soft_rate_loss += float(soft_rate_loss.detach().cpu())
-                running_hard_rate_loss += float(hard_rate_loss.detach().cpu())
-
-                if (i + 1) % log_interval == 0:
-                    current_loss = (running_total_loss - previous_total_loss) / log_interval
+                # collect running stats (no device sync)
+                running_stats.update(total_loss, distortion_loss_hard_quant, distortion_loss_soft_quant, rate_loss, hard_rate_metric, first_frame_loss, hard_rate_loss, soft_rate_loss)
+
+                if rank == 0 and (i + 1) % log_interval == 0:
+                    totals = running_stats.totals()
+                    now = time.perf_counter()
+                    current_loss = (totals['total_loss'] - previous_total_loss) / log_interval
+                    postfix = {name : total / (i + 1) for name, total in totals.items()}
                     tepoch.set_postfix(
                         current_loss=current_loss,
-                        total_loss=running_total_loss / (i + 1),
-                        dist_hq=running_hard_dist_loss / (i + 1),
-                        dist_sq=running_soft_dist_loss / (i + 1),
-                        rate_loss=running_rate_loss / (i + 1),
-                        rate=running_rate_metric / (i + 1),
-                        ffloss=running_first_frame_loss / (i + 1),
-                        rateloss_hard=running_hard_rate_loss / (i + 1),
-                        rateloss_soft=running_soft_rate_loss / (i + 1)
+                        **postfix,
+                        frames_per_sec=log_interval * batch_size * sequence_length / (now - interval_start),
+                        data_wait_ms=1000 * data_wait / log_interval
                     )
-                    previous_total_loss = running_total_loss
+                    previous_total_loss = totals['total_loss']
+                    interval_start = now
+                    data_wait = 0
+
+                step_end = time.perf_counter()
+
+        # epoch loss averaged over all processes
+        epoch_loss = running_stats.sums[0] / len(dataloader)
+        if distributed:
+            torch.distributed.all_reduce(epoch_loss)
+            epoch_loss /= world_size
 
         # save checkpoint
-        checkpoint_path = os.path.join(checkpoint_dir, f'checkpoint_epoch_{epoch}.pth')
-        checkpoint['state_dict'] = model.state_dict()
-        checkpoint['loss'] = running_total_loss / len(dataloader)
-        checkpoint['epoch'] = epoch
-        torch.save(checkpoint, checkpoint_path)
+        if rank == 0:
+            checkpoint_path = os.path.join(checkpoint_dir, f'checkpoint_epoch_{epoch}.pth')
+            checkpoint['state_dict'] = model.state_dict()
+            checkpoint['loss'] = float(epoch_loss)
+            checkpoint['epoch'] = epoch
+            torch.save(checkpoint, checkpoint_path)
+
+    if distributed:
+        torch.distributed.destroy_process_group()
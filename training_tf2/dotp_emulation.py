@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+'''Copyright (c) 2023 Amazon
+
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+""" NumPy emulation of the nnet.c GRU and dense kernels, for both the float and the
+    8-bit DOT_PROD builds
+
+    The functions work on exported arrays (anything mapping array names to flat
+    arrays, e.g. a weights_blob.WeightBlob or layer_arrays()) and on batches of
+    inputs, so the quantization loss can be measured on a whole eval set without
+    building the C library. With dotp=True, the inputs of the matrix products are
+    converted to u8 as 127+round(127*x), multiplied by the int8 weights (round(128*w))
+    and the result is scaled back by 1/(128*127), with the offset compensated by the
+    subias arrays (USE_SU_BIAS). With saturate=True, the sums of pairs of products
+    saturate to 16 bits like _mm256_maddubs_epi16() on AVX2.
+
+    The activations are computed exactly, not with the approximations of vec*.h.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+
+
+SCALE = 128.*127.
+
+def layer_arrays(layers, dotp=True):
+    """ name -> flat array mapping of a list of keraslayerdump.ExportedLayer """
+    arrays = dict()
+    for layer in layers:
+        for array in layer.arrays:
+            arrays[array.name] = array.variant(dotp)[1]
+    return arrays
+
+def sigmoid(x):
+    return .5 + .5*np.tanh(.5*x)
+
+activations = {
+    'LINEAR' : lambda x: x,
+    'SIGMOID' : sigmoid,
+    'TANH' : np.tanh,
+    'RELU' : lambda x: np.maximum(x, 0),
+    'SOFTMAX' : lambda x: np.exp(x - np.max(x, axis=-1, keepdims=True))/np.sum(np.exp(x - np.max(x, axis=-1, keepdims=True)), axis=-1, keepdims=True)
+}
+
+
+def dotp_matrix(w, nb_inputs, nb_outputs):
+    """ inverse of keraslayerdump.dotp_layout(), returns the (inputs, outputs) matrix """
+    w = np.reshape(w, (nb_outputs//8, nb_inputs//4, 8, 4))
+    return w.transpose((1, 3, 0, 2)).reshape((nb_inputs, nb_outputs))
+
+def sparse_matrix(w, idx, nb_inputs, nb_outputs, dotp=True):
+    """ unpacks 4x8 block-sparse weights (as written by keraslayerdump.sparse_arrays())
+        into a dense (inputs, outputs) matrix """
+    A = np.zeros((nb_inputs, nb_outputs), dtype=w.dtype)
+    w = np.reshape(w, (-1, 4, 8)) if not dotp else np.reshape(w, (-1, 8, 4)).transpose((0, 2, 1))
+    idx = np.asarray(idx)
+    block = 0
+    pos = 0
+    for i in range(nb_outputs//8):
+        count = idx[pos]
+        for j in idx[pos+1:pos+1+count]:
+            A[j:j+4, 8*i:8*i+8] = w[block]
+            block += 1
+        pos += 1 + count
+    return A
+
+def quantize_inputs(x):
+    """ u8 conversion of the inputs done by vector_ps_to_epi8() """
+    return np.clip(127 + np.floor(.5 + 127*np.asarray(x, dtype='float32')), 0, 255).astype('int32')
+
+def matmul(x, W, dotp=True, saturate=True, max_elements=1<<24):
+    """ x @ W as computed by the DOT_PROD kernels (without the bias), W holds the int8
+        weights when dotp is set """
+    x = np.asarray(x)
+    if not dotp:
+        return x @ W.astype('float32')
+    xq = quantize_inputs(x)
+    W = W.astype('int32')
+    if not saturate:
+        return (xq @ W)*(1./SCALE)
+    # pairs of adjacent inputs, processed in chunks to bound the size of the (batch, pairs, outputs) tensor
+    M = W.shape[0]//2*2
+    xp = xq[..., :M].reshape(xq.shape[:-1] + (M//2, 2))
+    Wp = W[:M].reshape((M//2, 2, W.shape[1]))
+    flat = xp.reshape((-1, M//2, 2))
+    out = np.zeros((flat.shape[0], W.shape[1]), dtype='int64')
+    chunk = max(1, max_elements//max(1, M//2*W.shape[1]))
+    for i in range(0, flat.shape[0], chunk):
+        pairs = np.einsum('bpk,pko->bpo', flat[i:i+chunk], Wp)
+        out[i:i+chunk] = np.sum(np.clip(pairs, -32768, 32767), axis=1)
+    out = out.reshape(xq.shape[:-1] + (W.shape[1],))
+    if W.shape[0] > M:
+        out += xq[..., M:] @ W[M:]
+    return out*(1./SCALE)
+
+
+class GRU:
+    """ GRULayer as used by compute_gruB(): block-sparse input weights, dense recurrent weights """
+    def __init__(self, arrays, name, nb_inputs, nb_neurons, activation='TANH', dotp=True, saturate=True):
+        N = nb_neurons
+        self.N = N
+        self.dotp = dotp
+        self.saturate = saturate
+        self.activation = activations[activation]
+        self.input_weights = sparse_matrix(arrays[name + '_weights'], arrays[name + '_weights_idx'], nb_inputs, 3*N, dotp=dotp)
+        w = arrays[name + '_recurrent_weights']
+        self.recurrent_weights = dotp_matrix(w, N, 3*N) if dotp else np.reshape(w, (N, 3*N))
+        self.bias = np.reshape(arrays[(name + '_subias') if dotp else (name + '_bias')], (2, 3*N))
+
+    def __call__(self, state, input, condition=0.):
+        """ one step for a batch of states (batch, N) and inputs (batch, nb_inputs) """
+        N = self.N
+        zrh = self.bias[0] + condition + matmul(input, self.input_weights, self.dotp, self.saturate)
+        recur = self.bias[1] + matmul(state, self.recurrent_weights, self.dotp, self.saturate)
+        z = sigmoid(zrh[..., :N] + recur[..., :N])
+        r = sigmoid(zrh[..., N:2*N] + recur[..., N:2*N])
+        h = self.activation(zrh[..., 2*N:] + recur[..., 2*N:]*r)
+        return z*state + (1 - z)*h
+
+class SparseGRU:
+    """ SparseGRULayer as used by compute_sparse_gru(), the input is the output of the
+        input matrix product (batch, 3N) """
+    def __init__(self, arrays, name, nb_neurons, activation='TANH', dotp=True, saturate=True):
+        N = nb_neurons
+        self.N = N
+        self.dotp = dotp
+        self.saturate = saturate
+        self.activation = activations[activation]
+        self.diag = np.reshape(arrays[name + '_recurrent_weights_diag'], (3, N))
+        self.recurrent_weights = sparse_matrix(arrays[name + '_recurrent_weights'], arrays[name + '_recurrent_weights_idx'], N, 3*N, dotp=dotp)
+        self.bias = np.reshape(arrays[(name + '_subias') if dotp else (name + '_bias')], (2, 3*N))[1]
+
+    def __call__(self, state, input):
+        N = self.N
+        recur = self.bias + np.concatenate([self.diag[0]*state, self.diag[1]*state, self.diag[2]*state], axis=-1)
+        recur = recur + matmul(state, self.recurrent_weights, self.dotp, self.saturate)
+        z = sigmoid(recur[..., :N] + input[..., :N])
+        r = sigmoid(recur[..., N:2*N] + input[..., N:2*N])
+        h = self.activation(recur[..., 2*N:]*r + input[..., 2*N:])
+        return z*state + (1 - z)*h
+
+class Dense:
+    """ DenseLayer, computed in float in both builds """
+    def __init__(self, arrays, name, nb_inputs, nb_outputs, activation='LINEAR'):
+        self.weights = np.reshape(arrays[name + '_weights'], (nb_inputs, nb_outputs))
+        self.bias = arrays[name + '_bias']
+        self.activation = activations[activation]
+
+    def __call__(self, input):
+        return self.activation(input @ self.weights + self.bias)
+
+
+def run_gru(gru, inputs, state=None):
+    """ runs a GRU over a batch of sequences (batch, time, inputs), returns (batch, time, N) """
+    state = np.zeros((inputs.shape[0], gru.N)) if state is None else state
+    outputs = []
+    for t in range(inputs.shape[1]):
+        state = gru(state, inputs[:, t])
+        outputs.append(state)
+    return np.stack(outputs, axis=1)
+
+def snr(reference, test):
+    """ SNR in dB of test against reference """
+    return 10*np.log10(np.sum(reference**2)/max(np.sum((reference - test)**2), 1e-30))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the quantization loss of the DOT_PROD kernels on a GRU layer of a Keras model')
+    parser.add_argument('model_file', type=str, help='model weight h5 file')
+    parser.add_argument('layer', type=str, help='exported GRU layer (e.g. gru_b, sparse_gru_a, plc_gru1)')
+    parser.add_argument('inputs', type=str, help='input sequences (batch, time, inputs) as a .npy file, the inputs of sparse GRUs are after the input matrix')
+    parser.add_argument('--model', choices=['lpcnet', 'plc'], help='type of the model, default: lpcnet', default='lpcnet')
+    parser.add_argument('--no-saturation', action='store_true', help='do not emulate the 16-bit saturation of the AVX2 kernels')
+
+    args = parser.parse_args()
+
+    from weights_blob import h5_layers
+    layers = {layer.name : layer for layer in h5_layers(args.model_file, args.model)}
+    if args.layer not in layers:
+        print(f"unknown layer {args.layer}", file=sys.stderr)
+        sys.exit(1)
+    layer = layers[args.layer]
+    inputs = np.load(args.inputs)
+
+    outputs = []
+    for dotp in (False, True):
+        arrays = layer_arrays([layer], dotp=dotp)
+        if layer.c_type == 'SparseGRULayer':
+            N, activation = layer.init_args[5], layer.init_args[6]
+            gru = SparseGRU(arrays, layer.name, N, activation[len('ACTIVATION_'):], dotp=dotp, saturate=not args.no_saturation)
+        else:
+            M, N, activation = layer.init_args[5], layer.init_args[6], layer.init_args[7]
+            gru = GRU(arrays, layer.name, M, N, activation[len('ACTIVATION_'):], dotp=dotp, saturate=not args.no_saturation)
+        outputs.append(run_gru(gru, inputs))
+
+    print(f"{args.layer}: SNR of the DOT_PROD output {snr(outputs[0], outputs[1]):.2f} dB, max abs error {np.max(np.abs(outputs[0] - outputs[1])):.5f}")
@@ -40,13 +40,16 @@ parser.add_argument('weights', metavar="<weight file>", type=str, help='model we
 parser.add_argument('--cond-size', type=int, help="conditioning size (default: 256)", default=256)
 parser.add_argument('--latent-dim', type=int, help="dimension of latent space (default: 80)", default=80)
 parser.add_argument('--quant-levels', type=int, help="number of quantization steps (default: 16)", default=16)
+parser.add_argument('--weights-blob', type=str, help='also write the encoder and decoder weights in binary format to this file', default=None)
+parser.add_argument('--jobs', type=int, help='number of processes used for formatting the C arrays (default 1)', default=1)
+parser.add_argument('--cache-dir', type=str, help='directory caching the formatted layers, only layers whose weights changed get formatted again', default=None)
 
 args = parser.parse_args()
 
 # now import the heavy stuff
 import tensorflow as tf
 import numpy as np
-from keraslayerdump import dump_conv1d_layer, dump_dense_layer, dump_gru_layer, printVector
+from keraslayerdump import LayerExporter, ExportCache, CWriter, BlobWriter, AtomicFile, printVector
 from rdovae import new_rdovae_model
 
 def start_header(header_fid, header_name):
@@ -125,6 +128,8 @@ if __name__ == "__main__":
 
 
 
+    cache = None if args.cache_dir is None else ExportCache(args.cache_dir)
+
     # encoder
     encoder_dense_names = [
         'enc_dense1',
@@ -146,43 +151,21 @@ if __name__ == "__main__":
         'bits_dense'
     ]
 
-    source_fid = open("dred_rdovae_enc_data.c", 'w')
-    header_fid = open("dred_rdovae_enc_data.h", 'w')
-
-    start_header(header_fid, "dred_rdovae_enc_data.h")
-    start_source(source_fid, "dred_rdovae_enc_data.h", os.path.basename(args.weights))
-
-    header_fid.write(
-f"""
-#include "dred_rdovae_constants.h"
-
-#include "nnet.h"
-"""
-    )
-
-    # dump GRUs
-    max_rnn_neurons_enc = max(
-        [
-            dump_gru_layer(encoder.get_layer(name), source_fid, header_fid, dotp=True, sparse=True)
-            for name in encoder_gru_names
-        ]
-    )
-
-    # dump conv layers
-    max_conv_inputs = max(
-        [
-            dump_conv1d_layer(encoder.get_layer(name), source_fid, header_fid)
-            for name in encoder_conv1d_names
-        ] 
-    )
-
-    # dump Dense layers
-    for name in encoder_dense_names:
-        layer = encoder.get_layer(name)
-        dump_dense_layer(layer, source_fid, header_fid)
-
-    # some global constants
-    header_fid.write(
+    enc_writer = CWriter("dred_rdovae_enc_data.c", "dred_rdovae_enc_data.h", 'RDOVAEEnc', 'init_rdovaeenc', 'rdovae_enc_arrays', model_file=os.path.basename(args.weights))
+    enc_writer.header.write('#include "dred_rdovae_constants.h"\n\n')
+    backends = [enc_writer]
+    if args.weights_blob is not None:
+        backends.append(BlobWriter(args.weights_blob))
+    with LayerExporter(backends, num_workers=args.jobs, cache=cache) as exporter:
+        for name in encoder_gru_names + encoder_conv1d_names + encoder_dense_names:
+            exporter.add_layer(encoder.get_layer(name))
+        exporter.write()
+
+        max_rnn_neurons_enc = exporter.max_size('rnn_neurons')
+        max_conv_inputs = exporter.max_size('conv_inputs')
+
+        # some global constants
+        enc_writer.header.write(
 f"""
 
 #define DRED_ENC_MAX_RNN_NEURONS {max_rnn_neurons_enc}
@@ -190,36 +173,25 @@ f"""
 #define DRED_ENC_MAX_CONV_INPUTS {max_conv_inputs}
 
 """
-    )
-
-    finish_header(header_fid)
-    finish_source(source_fid)
-
-    header_fid.close()
-    source_fid.close()
+        )
 
     # statistical model
-    source_fid = open("dred_rdovae_stats_data.c", 'w')
-    header_fid = open("dred_rdovae_stats_data.h", 'w')
-
-    start_header(header_fid, "dred_rdovae_stats_data.h")
-    start_source(source_fid, "dred_rdovae_stats_data.h", os.path.basename(args.weights))
+    with AtomicFile("dred_rdovae_stats_data.c") as source_fid, AtomicFile("dred_rdovae_stats_data.h") as header_fid:
+        start_header(header_fid, "dred_rdovae_stats_data.h")
+        start_source(source_fid, "dred_rdovae_stats_data.h", os.path.basename(args.weights))
 
-    header_fid.write(
+        header_fid.write(
 """
 
 #include "opus_types.h"
 
 """
-    )
-
-    dump_statistical_model(qembedding, source_fid, header_fid)
+        )
 
-    finish_header(header_fid)
-    finish_source(source_fid)
+        dump_statistical_model(qembedding, source_fid, header_fid)
 
-    header_fid.close()
-    source_fid.close()
+        finish_header(header_fid)
+        finish_source(source_fid)
 
     # decoder
     decoder_dense_names = [
@@ -240,54 +212,32 @@ f"""
         'dec_dense6'
     ] 
 
-    source_fid = open("dred_rdovae_dec_data.c", 'w')
-    header_fid = open("dred_rdovae_dec_data.h", 'w')
+    dec_writer = CWriter("dred_rdovae_dec_data.c", "dred_rdovae_dec_data.h", 'RDOVAEDec', 'init_rdovaedec', 'rdovae_dec_arrays', model_file=os.path.basename(args.weights))
+    dec_writer.header.write('#include "dred_rdovae_constants.h"\n\n')
+    backends = [dec_writer]
+    if args.weights_blob is not None:
+        backends.append(BlobWriter(args.weights_blob, append=True))
+    with LayerExporter(backends, num_workers=args.jobs, cache=cache) as exporter:
+        for name in decoder_gru_names + decoder_dense_names:
+            exporter.add_layer(decoder.get_layer(name))
+        exporter.write()
 
-    start_header(header_fid, "dred_rdovae_dec_data.h")
-    start_source(source_fid, "dred_rdovae_dec_data.h", os.path.basename(args.weights))
+        max_rnn_neurons_dec = exporter.max_size('rnn_neurons')
 
-    header_fid.write(
-f"""
-#include "dred_rdovae_constants.h"
-
-#include "nnet.h"
-"""
-    )
-
-
-    # dump GRUs
-    max_rnn_neurons_dec = max(
-        [
-            dump_gru_layer(decoder.get_layer(name), source_fid, header_fid, dotp=True, sparse=True)
-            for name in decoder_gru_names
-        ]
-    )
-
-    # dump Dense layers
-    for name in decoder_dense_names:
-        layer = decoder.get_layer(name)
-        dump_dense_layer(layer, source_fid, header_fid)
-
-    # some global constants
-    header_fid.write(
+        # some global constants
+        dec_writer.header.write(
 f"""
 
 #define DRED_DEC_MAX_RNN_NEURONS {max_rnn_neurons_dec}
 
 """
-    )
-
-    finish_header(header_fid)
-    finish_source(source_fid)
-
-    header_fid.close()
-    source_fid.close()
+        )
 
     # common constants
-    header_fid = open("dred_rdovae_constants.h", 'w')
-    start_header(header_fid, "dred_rdovae_constants.h")
+    with AtomicFile("dred_rdovae_constants.h") as header_fid:
+        start_header(header_fid, "dred_rdovae_constants.h")
 
-    header_fid.write(
+        header_fid.write(
 f"""
 #define DRED_NUM_FEATURES 20
 
@@ -301,6 +251,6 @@ f"""
 
 #define DRED_MAX_CONV_INPUTS {max_conv_inputs}
 """
-    )
+        )
 
-    finish_header(header_fid)
\ No newline at end of file
+        finish_header(header_fid)
\ No newline at end of file
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+'''Copyright (c) 2021-2022 Amazon
+
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+# Evaluate a PLC model on many (features, loss pattern) pairs
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Evaluate a PLC model on many files and loss patterns')
+
+parser.add_argument('weights', metavar='<weights file>', help='weights file (.h5)')
+parser.add_argument('pairs', metavar='<pairs file>', help='text file with one "<features file> <packet loss file> [offset]" per line (features as float32 from dump_data, loss as int8)')
+parser.add_argument('--output', metavar='<csv file>', help='write the metrics to this file instead of stdout')
+parser.add_argument('--model', metavar='<model>', default='lpcnet_plc', help='PLC model python definition (without .py)')
+parser.add_argument('--batch-size', metavar='<batch size>', default=32, type=int, help='number of pairs evaluated together (default 32)')
+parser.add_argument('--max-frames', metavar='<frames>', type=int, help='only evaluate the first frames of each file')
+parser.add_argument('--band-loss', metavar='<weight>', default=1.0, type=float, help='weight of band loss (default 1.0)')
+parser.add_argument('--loss-bias', metavar='<bias>', default=0.0, type=float, help='loss bias towards low energy (default 0.0)')
+
+args = parser.parse_args()
+
+import importlib
+lpcnet = importlib.import_module(args.model)
+
+import sys
+import numpy as np
+import tensorflow as tf
+from plc_losses import plc_loss_terms
+from lpcnet_plc import plc_sizes
+
+batch_size = args.batch_size
+
+# the model is only built and loaded once for the whole evaluation, with the sizes of the weights file
+gru_size, cond_size = plc_sizes(args.weights)
+model = lpcnet.new_lpcnet_plc_model(rnn_units=gru_size, batch_size=batch_size, training=False, quantize=False, cond_size=cond_size)
+model.compile()
+model.load_weights(args.weights)
+
+lpc_order = 16
+nb_used_features = model.nb_used_features
+nb_burg_features = model.nb_burg_features
+nb_features = nb_used_features + lpc_order + nb_burg_features
+
+metrics = ['loss', 'l1', 'ceps', 'band', 'pitch']
+
+pairs = []
+with open(args.pairs) as f:
+    for line in f:
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith('#'):
+            continue
+        pairs.append((fields[0], fields[1], int(fields[2]) if len(fields) > 2 else 0))
+
+def load_pair(feature_file, lost_file, offset):
+    features = np.memmap(feature_file, dtype='float32', mode='r')
+    features = np.reshape(features[:len(features)//nb_features*nb_features], (-1, nb_features))
+    if args.max_frames is not None:
+        features = features[:args.max_frames]
+    lost = np.memmap(lost_file, dtype='int8', mode='r')[offset:offset+features.shape[0]]
+    if len(lost) < features.shape[0]:
+        raise ValueError(f"{lost_file}: loss trace shorter than {feature_file}")
+    return features[:, :nb_used_features+nb_burg_features], lost.astype('float32')
+
+# the number of frames varies between batches, a single trace handles all of them
+@tf.function(input_signature=[tf.TensorSpec((batch_size, None, nb_used_features+nb_burg_features), tf.float32),
+                              tf.TensorSpec((batch_size, None, 1), tf.float32)])
+def predict(feat, lost):
+    return model([feat, lost], training=False)
+
+fout = sys.stdout if args.output is None else open(args.output, 'w')
+fout.write('features,lost,offset,frames,loss_rate,' + ','.join(metrics) + '\n')
+for start in range(0, len(pairs), batch_size):
+    batch = pairs[start:start+batch_size]
+    data = [load_pair(*pair) for pair in batch]
+    T = max(features.shape[0] for features, _ in data)
+
+    # padded frames are received (nothing to conceal) and trimmed before computing the metrics,
+    # unused rows of the last batch stay at zero
+    in_features = np.zeros((batch_size, T, nb_used_features+nb_burg_features), dtype='float32')
+    in_lost = np.ones((batch_size, T, 1), dtype='float32')
+    for i, (features, lost) in enumerate(data):
+        in_features[i, :len(lost)] = features*lost[:, None]
+        in_lost[i, :len(lost), 0] = lost
+
+    model.reset_states()
+    pred = predict(in_features, in_lost).numpy()
+
+    for i, (features, lost) in enumerate(data):
+        y_true = np.concatenate([features[:, nb_burg_features:], 1. - lost[:, None]], axis=-1)[None, :, :]
+        y_pred = pred[i:i+1, :len(lost), :]
+        terms = plc_loss_terms(tf.constant(y_true), tf.constant(y_pred), alpha=args.band_loss, bias=args.loss_bias)
+        values = [float(terms[name]) for name in metrics]
+        feature_file, lost_file, offset = batch[i]
+        fout.write('{},{},{},{},{:.4f},'.format(feature_file, lost_file, offset, len(lost), 1. - np.mean(lost)) + ','.join('{:.6f}'.format(v) for v in values) + '\n')
+    fout.flush()
+
+if args.output is not None:
+    fout.close()
@@ -24,166 +24,709 @@
    SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
-""" helper functions for dumping some Keras layers to C files """
+""" helper functions for dumping Keras layers to C files, weight blobs and numpy files
+
+    Layer dumpers are looked up in a registry keyed by the layer's class name (walking
+    up the class hierarchy), so they only depend on numpy. Each dumper turns a layer
+    into an ExportedLayer, i.e. the list of named weight arrays plus the C declarations
+    needed by the *_init() functions in parse_lpcnet_weights.c. A LayerExporter then
+    hands these records to one or more backends (CWriter, BlobWriter, NumpyWriter).
+"""
+
+import os
+import glob
+import struct
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
 
+# weight types as defined in nnet.h
+WEIGHT_TYPES = {'float' : 0, 'int' : 1, 'qweight' : 2}
+
+# must match WEIGHT_BLOB_VERSION, WEIGHT_BLOCK_SIZE and WeightHead in nnet.h
+WEIGHT_BLOB_VERSION = 0
+WEIGHT_BLOCK_SIZE = 64
+WEIGHT_HEAD_FORMAT = '<4siiii44s'
+WEIGHT_NAME_SIZE = 44
+
+
 def printVector(f, vector, name, dtype='float', dotp=False, static=True):
     """ prints vector as one-dimensional C array """
     if dotp:
-        vector = vector.reshape((vector.shape[0]//4, 4, vector.shape[1]//8, 8))
-        vector = vector.transpose((2, 0, 3, 1))
-    v = np.reshape(vector, (-1))
-    if static:
-        f.write('static const {} {}[{}] = {{\n   '.format(dtype, name, len(v)))
-    else:
-        f.write('const {} {}[{}] = {{\n   '.format(dtype, name, len(v)))
-    for i in range(0, len(v)):
-        f.write('{}'.format(v[i]))
-        if (i!=len(v)-1):
-            f.write(',')
-        else:
-            break;
-        if (i%8==7):
-            f.write("\n   ")
-        else:
-            f.write(" ")
-    f.write('\n};\n\n')
+        vector = dotp_layout(vector)
+    f.write(format_vector(vector, name, dtype=dtype, static=static) + '\n')
     return vector
 
-def printSparseVector(f, A, name, have_diag=True):
+def format_vector(vector, name, dtype='float', static=True):
+    """ returns the C definition of vector as a string """
+    v = np.reshape(vector, (-1))
+    values = [str(x) for x in v]
+    lines = [', '.join(values[i:i+8]) for i in range(0, len(values), 8)]
+    return '{}const {} {}[{}] = {{\n   {}\n}};\n'.format('static ' if static else '', dtype, name, len(v), ',\n   '.join(lines))
+
+def dotp_layout(vector):
+    """ reorders a (inputs, outputs) matrix into the 4x8 block layout used by the DOT_PROD kernels """
+    vector = vector.reshape((vector.shape[0]//4, 4, vector.shape[1]//8, 8))
+    return vector.transpose((2, 0, 3, 1))
+
+def quantize_weights(w):
+    """ 8-bit quantization used for the DOT_PROD kernels """
+    return np.clip(np.round(128.*w).astype('int'), -128, 127)
+
+
+class WeightArray:
+    """ named array as referenced by the WeightArray list in the generated C file
+
+        If dotp_data is set, the array has a different content (and possibly type)
+        when the C code is compiled with DOT_PROD.
+    """
+    def __init__(self, name, data, dtype='float', dotp_data=None, dotp_dtype='qweight'):
+        self.name = name
+        self.data = np.reshape(data, (-1))
+        self.dtype = dtype
+        self.dotp_data = None if dotp_data is None else np.reshape(dotp_data, (-1))
+        self.dotp_dtype = dotp_dtype
+
+    def variant(self, dotp):
+        """ returns (dtype, data) for a DOT_PROD or a regular build """
+        if dotp and self.dotp_data is not None:
+            return self.dotp_dtype, self.dotp_data
+        return self.dtype, self.data
+
+
+class ExportedLayer:
+    """ arrays and C declarations produced by a layer dumper """
+    def __init__(self, name, c_type=None, init_func=None, init_args=(), arrays=(), defines=(), has_state=False, **sizes):
+        self.name = name
+        self.c_type = c_type
+        self.init_func = init_func
+        self.init_args = list(init_args)
+        self.arrays = list(arrays)
+        self.defines = list(defines)
+        self.has_state = has_state
+        # buffer sizes the C code needs to know about (e.g. rnn_neurons, conv_inputs)
+        self.sizes = sizes
+
+    def init_call(self):
+        return '  if ({}(&model->{}, arrays, {})) return 1;\n'.format(self.init_func, self.name, ', '.join(str(a) for a in self.init_args))
+
+
+def _quote(name):
+    return '"{}"'.format(name)
+
+def _activation(layer, default='TANH'):
+    if hasattr(layer, 'activation'):
+        return layer.activation.__name__.upper()
+    return default
+
+def _reset_after(layer):
+    if hasattr(layer, 'reset_after') and not layer.reset_after:
+        return 0
+    return 1
+
+
+def sparse_arrays(A, name, have_diag=True):
+    """ packs A into the 4x8 block sparse format, returns the arrays and the quantized matrix """
+    A = np.copy(A)
     N = A.shape[0]
     M = A.shape[1]
-    W = np.zeros((0,), dtype='int')
-    W0 = np.zeros((0,))
+    arrays = []
     if have_diag:
         diag = np.concatenate([np.diag(A[:,:N]), np.diag(A[:,N:2*N]), np.diag(A[:,2*N:])])
         A[:,:N] = A[:,:N] - np.diag(np.diag(A[:,:N]))
         A[:,N:2*N] = A[:,N:2*N] - np.diag(np.diag(A[:,N:2*N]))
         A[:,2*N:] = A[:,2*N:] - np.diag(np.diag(A[:,2*N:]))
-        printVector(f, diag, name + '_diag')
+        arrays.append(WeightArray(name + '_diag', diag))
     AQ = np.minimum(127, np.maximum(-128, np.round(A*128))).astype('int')
-    idx = np.zeros((0,), dtype='int')
-    for i in range(M//8):
-        pos = idx.shape[0]
-        idx = np.append(idx, -1)
-        nb_nonzero = 0
-        for j in range(N//4):
-            block = A[j*4:(j+1)*4, i*8:(i+1)*8]
-            qblock = AQ[j*4:(j+1)*4, i*8:(i+1)*8]
-            if np.sum(np.abs(block)) > 1e-10:
-                nb_nonzero = nb_nonzero + 1
-                idx = np.append(idx, j*4)
-                vblock = qblock.transpose((1,0)).reshape((-1,))
-                W0 = np.concatenate([W0, block.reshape((-1,))])
-                W = np.concatenate([W, vblock])
-        idx[pos] = nb_nonzero
-    f.write('#ifdef DOT_PROD\n')
-    printVector(f, W, name, dtype='qweight')
-    f.write('#else /*DOT_PROD*/\n')
-    printVector(f, W0, name, dtype='qweight')
-    f.write('#endif /*DOT_PROD*/\n')
-    printVector(f, idx, name + '_idx', dtype='int')
-    return AQ
-
-def dump_sparse_gru(self, f, hf):
-    name = 'sparse_' + self.name
-    print("printing layer " + name + " of type sparse " + self.__class__.__name__)
-    weights = self.get_weights()
-    qweights = printSparseVector(f, weights[1], name + '_recurrent_weights')
-    printVector(f, weights[-1], name + '_bias')
-    subias = weights[-1].copy()
-    subias[1,:] = subias[1,:] - np.sum(qweights*(1./128),axis=0)
-    printVector(f, subias, name + '_subias')
-    if hasattr(self, 'activation'):
-        activation = self.activation.__name__.upper()
-    else:
-        activation = 'TANH'
-    if hasattr(self, 'reset_after') and not self.reset_after:
-        reset_after = 0
-    else:
-        reset_after = 1
-    neurons = weights[0].shape[1]//3
-    max_rnn_neurons = neurons
-    f.write('const SparseGRULayer {} = {{\n   {}_bias,\n   {}_subias,\n   {}_recurrent_weights_diag,\n   {}_recurrent_weights,\n   {}_recurrent_weights_idx,\n   {}, ACTIVATION_{}, {}\n}};\n\n'
-            .format(name, name, name, name, name, name, weights[0].shape[1]//3, activation, reset_after))
-    hf.write('#define {}_OUT_SIZE {}\n'.format(name.upper(), weights[0].shape[1]//3))
-    hf.write('#define {}_STATE_SIZE {}\n'.format(name.upper(), weights[0].shape[1]//3))
-    hf.write('extern const SparseGRULayer {};\n\n'.format(name));
-    return max_rnn_neurons
-
-def dump_gru_layer(self, f, hf, dotp=False, sparse=False):
-    name = self.name
-    print("printing layer " + name + " of type " + self.__class__.__name__)
-    weights = self.get_weights()
-    if sparse:
-        qweight = printSparseVector(f, weights[0], name + '_weights', have_diag=False)
-    else:
-        qweight = printVector(f, weights[0], name + '_weights')
 
-    if dotp:
-        f.write('#ifdef DOT_PROD\n')
-        qweight2 = np.clip(np.round(128.*weights[1]).astype('int'), -128, 127)
-        printVector(f, qweight2, name + '_recurrent_weights', dotp=True, dtype='qweight')
-        f.write('#else /*DOT_PROD*/\n')
-    else:
-        qweight2 = weights[1]
-
-    printVector(f, weights[1], name + '_recurrent_weights')
-    if dotp:
-        f.write('#endif /*DOT_PROD*/\n')
+    # (column block, row block, 4, 8)
+    blocks = A[:N//4*4, :M//8*8].reshape((N//4, 4, M//8, 8)).transpose((2, 0, 1, 3))
+    qblocks = AQ[:N//4*4, :M//8*8].reshape((N//4, 4, M//8, 8)).transpose((2, 0, 1, 3))
+    nonzero = np.sum(np.abs(blocks), axis=(2, 3)) > 1e-10
+
+    W0 = blocks[nonzero].reshape((-1,)).astype('float64')
+    W = qblocks[nonzero].transpose((0, 2, 1)).reshape((-1,))
+    idx = []
+    for nz in nonzero:
+        idx.append(np.sum(nz))
+        idx.extend(4*np.nonzero(nz)[0])
+    idx = np.array(idx, dtype='int')
+
+    arrays.append(WeightArray(name, W0, dtype='qweight', dotp_data=W, dotp_dtype='qweight'))
+    arrays.append(WeightArray(name + '_idx', idx, dtype='int'))
+    return arrays, AQ
+
+
+def sparse_gate_stats(A, have_diag=True, gates=('update', 'reset', 'state'), clip=0.992):
+    """ per-gate statistics of the 4x8 block-sparse packing done by sparse_arrays()
 
-    printVector(f, weights[-1], name + '_bias')
+        Besides the block density and the multiply-accumulates per call, this
+        checks the 8-bit saturation risk: WeightClip(clip) keeps the sum of the
+        magnitudes of adjacent weights below clip (127 once quantized), whereas the
+        DOT_PROD kernels add pairs of adjacent inputs of each 4x8 block.
+    """
+    A = np.array(A, dtype='float64')
+    N = A.shape[0]
+    G = A.shape[1]//len(gates)
+    stats = []
+    for i, gate in enumerate(gates):
+        B = A[:, i*G:(i+1)*G]
+        clip_pairs = np.abs(B[:, 0::2]) + np.abs(B[:, 1::2])
+        diag = np.zeros(0)
+        if have_diag:
+            diag = np.diag(B).copy()
+            B = B - np.diag(diag)
+        blocks = B[:N//4*4, :G//8*8].reshape((N//4, 4, G//8, 8)).transpose((2, 0, 1, 3))
+        nonzero = np.sum(np.abs(blocks), axis=(2, 3)) > 1e-10
+        qblocks = np.abs(quantize_weights(blocks[nonzero]))
+        # pairs of adjacent inputs as seen by the kernels, and pairs of adjacent outputs as constrained by WeightClip
+        kernel_pairs = qblocks[:, 0::2, :] + qblocks[:, 1::2, :]
+        stats.append(dict(gate=gate,
+                          blocks=int(np.sum(nonzero)),
+                          total_blocks=nonzero.size,
+                          density=float(np.mean(nonzero)) if nonzero.size else 0.,
+                          diag=len(diag),
+                          macs=32*int(np.sum(nonzero)) + len(diag),
+                          clipped=int(np.sum(np.abs(np.round(128*blocks[nonzero])) > 127)),
+                          clip_violations=int(np.sum(clip_pairs > clip + 1e-6)),
+                          saturating_pairs=int(np.sum(kernel_pairs > 127)),
+                          max_pair=int(np.max(kernel_pairs)) if kernel_pairs.size else 0))
+    return stats
+
+def sparse_gru_report(name, A, have_diag=True, rate=16000):
+    """ human readable density and cost report for one block-sparse GRU matrix, returns
+        the lines and the GFLOPS when run once per sample at the given rate """
+    stats = sparse_gate_stats(A, have_diag=have_diag)
+    lines = ['{}: {}x{} matrix, {}'.format(name, A.shape[0], A.shape[1], 'diagonal exported separately as float' if have_diag else 'no diagonal')]
+    total_macs = 0
+    for s in stats:
+        total_macs += s['macs']
+        lines.append('  {:7s} {:5d}/{:5d} blocks, density {:6.2%}, {:7d} MACs, {} clipped, {} WeightClip violations, {} saturating pairs (max {})'.format(
+            s['gate'], s['blocks'], s['total_blocks'], s['density'], s['macs'], s['clipped'], s['clip_violations'], s['saturating_pairs'], s['max_pair']))
+    gflops = 2.*total_macs*rate/1e9
+    lines.append('  total   {:7d} MACs per call, {:.3f} GFLOPS at {} Hz'.format(total_macs, gflops, rate))
+    return lines, gflops
+
+
+def dense_layer_impl(name, weights, bias, activation):
+    return ExportedLayer(name, 'DenseLayer', 'dense_init',
+            [_quote(name + '_bias'), _quote(name + '_weights'), weights.shape[0], weights.shape[1], 'ACTIVATION_' + activation],
+            arrays=[WeightArray(name + '_weights', weights), WeightArray(name + '_bias', bias)],
+            defines=[(name.upper() + '_OUT_SIZE', weights.shape[1])])
+
+def embedding_layer_impl(name, weights):
+    return ExportedLayer(name, 'EmbeddingLayer', 'embedding_init',
+            [_quote(name + '_weights'), weights.shape[0], weights.shape[1]],
+            arrays=[WeightArray(name + '_weights', weights)],
+            defines=[(name.upper() + '_OUT_SIZE', weights.shape[1])])
+
+def gru_state_layer(layer):
+    """ only exports the size of a GRU state (when the weights are exported separately) """
+    name = layer.name
+    weights = layer.get_weights()
+    N = weights[0].shape[1]//3
+    return ExportedLayer(name, defines=[(name.upper() + '_OUT_SIZE', N), (name.upper() + '_STATE_SIZE', N)], has_state=True)
+
+def gru_layer(layer, nb_inputs=None):
+    """ GRU with block-sparse input weights and dense recurrent weights, optionally
+        only using the first nb_inputs rows of the input weights """
+    name = layer.name
+    weights = layer.get_weights()
+    W = weights[0] if nb_inputs is None else weights[0][:nb_inputs, :]
+    N = weights[0].shape[1]//3
+    arrays, qweight = sparse_arrays(W, name + '_weights', have_diag=False)
+
+    qweight2 = quantize_weights(weights[1])
+    arrays.append(WeightArray(name + '_recurrent_weights', weights[1], dotp_data=dotp_layout(qweight2)))
+    arrays.append(WeightArray(name + '_bias', weights[-1]))
     subias = weights[-1].copy()
     subias[0,:] = subias[0,:] - np.sum(qweight*(1./128.),axis=0)
     subias[1,:] = subias[1,:] - np.sum(qweight2*(1./128.),axis=0)
-    printVector(f, subias, name + '_subias')
-    if hasattr(self, 'activation'):
-        activation = self.activation.__name__.upper()
-    else:
-        activation = 'TANH'
-    if hasattr(self, 'reset_after') and not self.reset_after:
-        reset_after = 0
-    else:
-        reset_after = 1
-    neurons = weights[0].shape[1]//3
-    max_rnn_neurons = neurons
-    f.write('const GRULayer {} = {{\n   {}_bias,\n   {}_subias,\n   {}_weights,\n   {},\n   {}_recurrent_weights,\n   {}, {}, ACTIVATION_{}, {}\n}};\n\n'
-            .format(name, name, name, name, name + "_weights_idx" if sparse else "NULL", name, weights[0].shape[0], weights[0].shape[1]//3, activation, reset_after))
-    hf.write('#define {}_OUT_SIZE {}\n'.format(name.upper(), weights[0].shape[1]//3))
-    hf.write('#define {}_STATE_SIZE {}\n'.format(name.upper(), weights[0].shape[1]//3))
-    hf.write('extern const GRULayer {};\n\n'.format(name));
-    return max_rnn_neurons
-
-def dump_dense_layer_impl(name, weights, bias, activation, f, hf):
-    printVector(f, weights, name + '_weights')
-    printVector(f, bias, name + '_bias')
-    f.write('const DenseLayer {} = {{\n   {}_bias,\n   {}_weights,\n   {}, {}, ACTIVATION_{}\n}};\n\n'
-            .format(name, name, name, weights.shape[0], weights.shape[1], activation))
-    hf.write('#define {}_OUT_SIZE {}\n'.format(name.upper(), weights.shape[1]))
-    hf.write('extern const DenseLayer {};\n\n'.format(name));
-
-def dump_dense_layer(self, f, hf):
-    name = self.name
-    print("printing layer " + name + " of type " + self.__class__.__name__)
-    weights = self.get_weights()
-    activation = self.activation.__name__.upper()
-    dump_dense_layer_impl(name, weights[0], weights[1], activation, f, hf)
-    return False
-
-def dump_conv1d_layer(self, f, hf):
-    name = self.name
-    print("printing layer " + name + " of type " + self.__class__.__name__)
-    weights = self.get_weights()
-    printVector(f, weights[0], name + '_weights')
-    printVector(f, weights[-1], name + '_bias')
-    activation = self.activation.__name__.upper()
-    max_conv_inputs = weights[0].shape[1]*weights[0].shape[0]
-    f.write('const Conv1DLayer {} = {{\n   {}_bias,\n   {}_weights,\n   {}, {}, {}, ACTIVATION_{}\n}};\n\n'
-            .format(name, name, name, weights[0].shape[1], weights[0].shape[0], weights[0].shape[2], activation))
-    hf.write('#define {}_OUT_SIZE {}\n'.format(name.upper(), weights[0].shape[2]))
-    hf.write('#define {}_STATE_SIZE ({}*{})\n'.format(name.upper(), weights[0].shape[1], (weights[0].shape[0]-1)))
-    hf.write('#define {}_DELAY {}\n'.format(name.upper(), (weights[0].shape[0]-1)//2))
-    hf.write('extern const Conv1DLayer {};\n\n'.format(name));
-    return max_conv_inputs
+    arrays.append(WeightArray(name + '_subias', subias))
+
+    return ExportedLayer(name, 'GRULayer', 'gru_init',
+            [_quote(name + s) for s in ['_bias', '_subias', '_weights', '_weights_idx', '_recurrent_weights']]
+            + [W.shape[0], N, 'ACTIVATION_' + _activation(layer), _reset_after(layer)],
+            arrays=arrays,
+            defines=[(name.upper() + '_OUT_SIZE', N), (name.upper() + '_STATE_SIZE', N)],
+            has_state=True, rnn_neurons=N)
+
+def sparse_gru_layer(layer):
+    """ GRU whose recurrent weights are split into a diagonal and a block-sparse part
+        (only the recurrent part is exported, as sparse_<name>) """
+    name = 'sparse_' + layer.name
+    weights = layer.get_weights()
+    N = weights[0].shape[1]//3
+    arrays, qweights = sparse_arrays(weights[1], name + '_recurrent_weights')
+    arrays.append(WeightArray(name + '_bias', weights[-1]))
+    subias = weights[-1].copy()
+    subias[1,:] = subias[1,:] - np.sum(qweights*(1./128),axis=0)
+    arrays.append(WeightArray(name + '_subias', subias))
+
+    return ExportedLayer(name, 'SparseGRULayer', 'sparse_gru_init',
+            [_quote(name + s) for s in ['_bias', '_subias', '_recurrent_weights_diag', '_recurrent_weights', '_recurrent_weights_idx']]
+            + [N, 'ACTIVATION_' + _activation(layer), _reset_after(layer)],
+            arrays=arrays,
+            defines=[(name.upper() + '_OUT_SIZE', N), (name.upper() + '_STATE_SIZE', N)],
+            rnn_neurons=N)
+
+
+# registry of layer dumpers, keyed by layer class name
+_layer_dumpers = dict()
+
+def register_layer_dumper(*type_names):
+    """ decorator registering a dumper for all layers of the given types (and their subclasses) """
+    def register(func):
+        for type_name in type_names:
+            _layer_dumpers[type_name] = func
+        return func
+    return register
+
+def get_layer_dumper(layer, overrides=None):
+    """ returns the dumper for layer, an override set to None skips the layer silently """
+    for cls in type(layer).__mro__:
+        if overrides is not None and cls.__name__ in overrides:
+            return overrides[cls.__name__] or _skip_layer
+        if cls.__name__ in _layer_dumpers:
+            return _layer_dumpers[cls.__name__]
+    return ignore_layer
+
+def _skip_layer(layer):
+    return None
+
+@register_layer_dumper('Layer')
+def ignore_layer(layer):
+    print("ignoring layer " + layer.name + " of type " + layer.__class__.__name__)
+    return None
+
+@register_layer_dumper('Dense')
+def dump_dense_layer(layer):
+    weights = layer.get_weights()
+    return dense_layer_impl(layer.name, weights[0], weights[1], layer.activation.__name__.upper())
+
+@register_layer_dumper('MDense')
+def dump_mdense_layer(layer):
+    name = layer.name
+    weights = layer.get_weights()
+    return ExportedLayer(name, 'MDenseLayer', 'mdense_init',
+            [_quote(name + '_bias'), _quote(name + '_weights'), _quote(name + '_factor'),
+             weights[0].shape[1], weights[0].shape[0], weights[0].shape[2], 'ACTIVATION_' + layer.activation.__name__.upper()],
+            arrays=[WeightArray(name + '_weights', np.transpose(weights[0], (0, 2, 1))),
+                    WeightArray(name + '_bias', np.transpose(weights[1], (1, 0))),
+                    WeightArray(name + '_factor', np.transpose(weights[2], (1, 0)))],
+            defines=[(name.upper() + '_OUT_SIZE', weights[0].shape[0])],
+            mdense_tmp=weights[0].shape[0]*weights[0].shape[2])
+
+@register_layer_dumper('Conv1D')
+def dump_conv1d_layer(layer):
+    name = layer.name
+    weights = layer.get_weights()
+    return ExportedLayer(name, 'Conv1DLayer', 'conv1d_init',
+            [_quote(name + '_bias'), _quote(name + '_weights'),
+             weights[0].shape[1], weights[0].shape[0], weights[0].shape[2], 'ACTIVATION_' + layer.activation.__name__.upper()],
+            arrays=[WeightArray(name + '_weights', weights[0]), WeightArray(name + '_bias', weights[-1])],
+            defines=[(name.upper() + '_OUT_SIZE', weights[0].shape[2]),
+                     (name.upper() + '_STATE_SIZE', '({}*{})'.format(weights[0].shape[1], weights[0].shape[0]-1)),
+                     (name.upper() + '_DELAY', (weights[0].shape[0]-1)//2)],
+            has_state=True, conv_inputs=weights[0].shape[1]*weights[0].shape[0])
+
+@register_layer_dumper('Embedding', 'diff_Embed')
+def dump_embedding_layer(layer):
+    return embedding_layer_impl(layer.name, layer.get_weights()[0])
+
+@register_layer_dumper('GRU')
+def dump_gru_layer(layer):
+    return gru_layer(layer)
+
+
+# backends
+
+class AtomicFile:
+    """ file written under a temporary name and renamed on close, so that an interrupted
+        export never leaves a truncated output behind """
+    def __init__(self, filename, mode='w'):
+        self.filename = filename
+        self.closed = False
+        fd, self.tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.' + os.path.basename(filename) + '.')
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmp_name, 0o666 & ~umask)
+        self.file = os.fdopen(fd, mode)
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def finish(self):
+        """ completes the temporary file, the output is only replaced by commit() """
+        self.file.close()
+
+    def commit(self):
+        if not self.closed:
+            self.finish()
+            os.replace(self.tmp_name, self.filename)
+            self.closed = True
+
+    def close(self):
+        try:
+            self.commit()
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        """ removes the temporary file and leaves the output untouched """
+        if not self.closed:
+            self.closed = True
+            self.file.close()
+            if os.path.exists(self.tmp_name):
+                os.remove(self.tmp_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class ExportCache:
+    """ formatted C code of previously exported layers, keyed by a hash of their arrays
+
+        Only the max_entries most recently used layers are kept.
+    """
+    # bump when the C formatting changes
+    version = 1
+
+    def __init__(self, where, max_entries=256):
+        self.where = where
+        self.max_entries = max_entries
+        os.makedirs(where, exist_ok=True)
+
+    def key(self, layer):
+        h = hashlib.sha256('{} {}'.format(self.version, layer.name).encode())
+        for array in layer.arrays:
+            for dtype, data in [(array.dtype, array.data), (array.dotp_dtype, array.dotp_data)]:
+                if data is None:
+                    continue
+                h.update('{} {} {} {}'.format(array.name, dtype, data.dtype.str, data.shape).encode())
+                h.update(np.ascontiguousarray(data).tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        filename = os.path.join(self.where, key + '.c')
+        if not os.path.exists(filename):
+            return None
+        os.utime(filename)
+        with open(filename, 'r') as f:
+            return f.read()
+
+    def put(self, key, text):
+        with AtomicFile(os.path.join(self.where, key + '.c')) as f:
+            f.write(text)
+        entries = sorted(glob.glob(os.path.join(self.where, '*.c')), key=os.path.getmtime)
+        for filename in entries[:max(0, len(entries) - self.max_entries)]:
+            os.remove(filename)
+
+
+def _format_c_array(array):
+    """ C definition of a WeightArray, guarded for USE_WEIGHTS_FILE builds """
+    def guarded(dtype, data):
+        return ('#ifndef USE_WEIGHTS_FILE\n'
+                + '#define WEIGHTS_{}_DEFINED\n'.format(array.name)
+                + '#define WEIGHTS_{}_TYPE WEIGHT_TYPE_{}\n'.format(array.name, dtype)
+                + format_vector(data, array.name, dtype=dtype)
+                + '#endif\n\n')
+    if array.dotp_data is None:
+        return guarded(array.dtype, array.data)
+    return ('#ifdef DOT_PROD\n' + guarded(array.dotp_dtype, array.dotp_data)
+            + '#else /*DOT_PROD*/\n' + guarded(array.dtype, array.data)
+            + '#endif /*DOT_PROD*/\n')
+
+def _format_c_layer(layer):
+    return ''.join(_format_c_array(array) for array in layer.arrays)
+
+
+class ExportBackend:
+    """ output of a LayerExporter
+
+        finish() writes the complete output to temporary files, commit() moves them in place
+        and discard() removes the ones not committed yet.
+    """
+    def finish(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def discard(self):
+        pass
+
+    def close(self):
+        try:
+            self.finish()
+            self.commit()
+        except BaseException:
+            self.discard()
+            raise
+
+
+class CWriter(ExportBackend):
+    """ writes the arrays to a C source file along with a header declaring the model
+        structure and its init function, as expected by parse_lpcnet_weights.c """
+    def __init__(self, source_name, header_name, model_type, init_func, arrays_name, state_type=None, model_file=None):
+        self.source_name = source_name
+        self.header_name = header_name
+        self.model_type = model_type
+        self.init_func = init_func
+        self.arrays_name = arrays_name
+        self.state_type = state_type
+        self.array_list = []
+        self.state_list = []
+        self.model_struct = []
+        self.model_init = []
+
+        self.source = AtomicFile(source_name)
+        try:
+            self.header = AtomicFile(header_name)
+        except BaseException:
+            self.source.discard()
+            raise
+        header_guard = os.path.basename(header_name).replace('.', '_').upper()
+
+        self.source.write('/*This file is automatically generated from a Keras model*/\n')
+        if model_file is not None:
+            self.source.write('/*based on model {}*/\n'.format(model_file))
+        self.source.write('\n')
+        self.source.write('#ifdef HAVE_CONFIG_H\n#include "config.h"\n#endif\n\n#include "nnet.h"\n#include "{}"\n\n'.format(os.path.basename(header_name)))
+        self.header.write('/*This file is automatically generated from a Keras model*/\n\n')
+        self.header.write('#ifndef {}\n#define {}\n\n#include "nnet.h"\n\n'.format(header_guard, header_guard))
+
+    def write_layers(self, layers, executor=None, cache=None):
+        blocks = [None]*len(layers)
+        if cache is not None:
+            keys = [cache.key(layer) for layer in layers]
+            blocks = [cache.get(key) for key in keys]
+        missing = [i for i, block in enumerate(blocks) if block is None]
+        if len(missing) < len(layers):
+            print("reusing {} cached layer(s)".format(len(layers) - len(missing)))
+        formatted = (map if executor is None else executor.map)(_format_c_layer, [layers[i] for i in missing])
+        for i, text in zip(missing, formatted):
+            blocks[i] = text
+            if cache is not None:
+                cache.put(keys[i], text)
+
+        for layer, block in zip(layers, blocks):
+            for array in layer.arrays:
+                if array.name not in self.array_list:
+                    self.array_list.append(array.name)
+            self.source.write(block)
+
+        for layer in layers:
+            for define, value in layer.defines:
+                self.header.write('#define {} {}\n'.format(define, value))
+            if layer.has_state:
+                self.state_list.append(layer.name)
+            if layer.c_type is not None:
+                self.model_struct.append('  {} {};\n'.format(layer.c_type, layer.name))
+                self.model_init.append(layer.init_call())
+
+    def finish(self):
+        self.source.write('#ifndef USE_WEIGHTS_FILE\n')
+        self.source.write('const WeightArray {}[] = {{\n'.format(self.arrays_name))
+        for name in self.array_list:
+            self.source.write('#ifdef WEIGHTS_{}_DEFINED\n'.format(name))
+            self.source.write('  {{"{}", WEIGHTS_{}_TYPE, sizeof({}), {}}},\n'.format(name, name, name, name))
+            self.source.write('#endif\n')
+        self.source.write('  {NULL, 0, 0, NULL}\n};\n')
+        self.source.write('#endif\n')
+
+        self.source.write('#ifndef DUMP_BINARY_WEIGHTS\n')
+        self.source.write('int {}({} *model, const WeightArray *arrays) {{\n'.format(self.init_func, self.model_type))
+        self.source.write(''.join(self.model_init))
+        self.source.write('  return 0;\n}\n')
+        self.source.write('#endif\n')
+
+        if self.state_type is not None:
+            self.header.write('\ntypedef struct {\n')
+            for name in self.state_list:
+                self.header.write('  float {}_state[{}_STATE_SIZE];\n'.format(name, name.upper()))
+            self.header.write('}} {};\n\n'.format(self.state_type))
+
+        self.header.write('typedef struct {\n')
+        self.header.write(''.join(self.model_struct))
+        self.header.write('}} {};\n\n'.format(self.model_type))
+        self.header.write('int {}({} *model, const WeightArray *arrays);\n\n'.format(self.init_func, self.model_type))
+        self.header.write('\n\n#endif\n')
+
+        self.source.finish()
+        self.header.finish()
+
+    def commit(self):
+        self.source.commit()
+        self.header.commit()
+
+    def discard(self):
+        self.source.discard()
+        self.header.discard()
+
+
+class BlobWriter(ExportBackend):
+    """ writes the arrays in the binary format read by parse_weights() (same as write_lpcnet_weights) """
+    dtypes = {'float' : '<f4', 'int' : '<i4'}
+
+    def __init__(self, filename, dotp=True, append=False):
+        self.dotp = dotp
+        self.file = AtomicFile(filename, 'wb')
+        # with append, the records of an existing file are kept unless an array of the same name is written
+        self.existing = []
+        self.records = []
+        self.names = set()
+        if append and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset + WEIGHT_BLOCK_SIZE <= len(data):
+                block_size, name = struct.unpack_from(WEIGHT_HEAD_FORMAT, data, offset)[4:]
+                end = offset + WEIGHT_BLOCK_SIZE + block_size
+                self.existing.append((name[:name.index(0)].decode(), data[offset:end]))
+                offset = end
+
+    def record(self, array):
+        dtype, data = array.variant(self.dotp)
+        if dtype == 'qweight':
+            data = data.astype('int8') if self.dotp else data.astype('<f4')
+        else:
+            data = data.astype(self.dtypes[dtype])
+        name = array.name.encode()
+        if len(name) >= WEIGHT_NAME_SIZE:
+            raise ValueError(f"BlobWriter: array name {array.name} is too long")
+        payload = data.tobytes()
+        block_size = (len(payload) + WEIGHT_BLOCK_SIZE - 1)//WEIGHT_BLOCK_SIZE*WEIGHT_BLOCK_SIZE
+        head = struct.pack(WEIGHT_HEAD_FORMAT, b'DNNw', WEIGHT_BLOB_VERSION, WEIGHT_TYPES[dtype], len(payload), block_size, name)
+        return head + payload + bytes(block_size - len(payload))
+
+    def write_layers(self, layers, executor=None, cache=None):
+        for layer in layers:
+            for array in layer.arrays:
+                self.names.add(array.name)
+                self.records.append(self.record(array))
+
+    def finish(self):
+        for name, record in self.existing:
+            if name not in self.names:
+                self.file.write(record)
+        for record in self.records:
+            self.file.write(record)
+        self.file.finish()
+
+    def commit(self):
+        self.file.commit()
+
+    def discard(self):
+        self.file.discard()
+
+
+class NumpyWriter(ExportBackend):
+    """ saves each array as <name>.npy (and <name>_dotp.npy for the DOT_PROD variant) """
+    def __init__(self, where):
+        self.where = where
+        self.files = []
+        os.makedirs(where, exist_ok=True)
+
+    def write_layers(self, layers, executor=None, cache=None):
+        for layer in layers:
+            for array in layer.arrays:
+                self.save(array.name + '.npy', array.data)
+                if array.dotp_data is not None:
+                    self.save(array.name + '_dotp.npy', array.dotp_data)
+
+    def save(self, name, data):
+        f = AtomicFile(os.path.join(self.where, name), 'wb')
+        self.files.append(f)
+        np.save(f, data)
+        f.finish()
+
+    def commit(self):
+        for f in self.files:
+            f.commit()
+
+    def discard(self):
+        for f in self.files:
+            f.discard()
+
+
+class LayerExporter:
+    """ collects exported layers and writes them to all backends
+
+        overrides maps layer type names to dumpers that replace the registered ones
+        for this export only. With num_workers > 1, the C arrays are formatted by
+        a pool of worker processes. With an ExportCache, layers whose arrays did not
+        change since a previous export are not formatted again. Used as a context
+        manager, the backends are closed on success and discarded on error.
+    """
+    def __init__(self, backends, overrides=None, num_workers=1, cache=None):
+        self.backends = list(backends)
+        self.overrides = overrides
+        self.num_workers = num_workers
+        self.cache = cache
+        self.layers = []
+        self.pending = []
+
+    def add(self, exported):
+        if exported is not None:
+            print("printing layer " + exported.name)
+            self.layers.append(exported)
+            self.pending.append(exported)
+        return exported
+
+    def add_layer(self, layer):
+        return self.add(get_layer_dumper(layer, self.overrides)(layer))
+
+    def add_model(self, model):
+        for layer in model.layers:
+            self.add_layer(layer)
+
+    def max_size(self, key, default=1):
+        return max([default] + [layer.sizes[key] for layer in self.layers if key in layer.sizes])
+
+    def write(self):
+        """ writes all layers added since the last call """
+        if self.num_workers > 1:
+            with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                for backend in self.backends:
+                    backend.write_layers(self.pending, executor, self.cache)
+        else:
+            for backend in self.backends:
+                backend.write_layers(self.pending, cache=self.cache)
+        self.pending = []
+
+    def close(self):
+        """ writes the remaining layers, the outputs are only replaced once all backends are complete """
+        try:
+            self.write()
+            for backend in self.backends:
+                backend.finish()
+            for backend in self.backends:
+                backend.commit()
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        """ drops the output of all backends that were not committed yet """
+        for backend in self.backends:
+            backend.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
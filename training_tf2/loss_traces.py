@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+'''Copyright (c) 2021-2022 Amazon
+
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+""" packet loss patterns for PLC training
+
+    Loss patterns are int8 sequences with 1 for a received packet and 0 for a
+    lost packet.
+"""
+
+import numpy as np
+
+
+def loss_statistics(lost):
+    """ loss rate and mean burst length of each row of lost (n, T) """
+    lost = np.asarray(lost) == 0
+    nb_lost = np.sum(lost, axis=1)
+    nb_bursts = lost[:, 0].astype('int') + np.sum(lost[:, 1:] & ~lost[:, :-1], axis=1)
+    return nb_lost/lost.shape[1], nb_lost/np.maximum(nb_bursts, 1)
+
+
+class LossTraceBank:
+    """ recorded loss traces, kept memory-mapped as int8
+
+        The file is split into traces of trace_length packets (a single trace by
+        default), and a sequence is addressed by (trace, offset). For sampling,
+        each trace is divided into windows of seq_length packets whose loss rate
+        and mean burst length are computed once (a few bytes per window, in chunks
+        so memory does not depend on the size of the file). Stratified sampling
+        bins windows by quantiles of these statistics and draws uniformly over
+        the bins, so rare conditions (long bursts, high loss) are seen as often as
+        common ones.
+    """
+    def __init__(self, lost, seq_length, trace_length=None, nb_rate_bins=4, nb_burst_bins=4, chunk_windows=4096):
+        self.lost = lost
+        self.seq_length = seq_length
+        self.trace_length = len(lost) if trace_length is None else trace_length
+        self.nb_traces = len(lost)//self.trace_length
+        # leave room for a random offset of up to seq_length within each window
+        self.nb_windows = self.trace_length//seq_length - 1
+        if self.nb_traces < 1 or self.nb_windows < 1:
+            raise ValueError(f"loss traces too short for sequences of {seq_length} packets")
+
+        nb = self.nb_traces*self.nb_windows
+        rate = np.zeros(nb, dtype='float32')
+        burst = np.zeros(nb, dtype='float32')
+        for start in range(0, nb, chunk_windows):
+            windows = np.arange(start, min(nb, start + chunk_windows))
+            rate[windows], burst[windows] = loss_statistics(self.get(windows//self.nb_windows, windows%self.nb_windows*seq_length))
+        self.rate = rate
+        self.burst = burst
+
+        rate_bin = np.digitize(rate, np.unique(np.quantile(rate, np.linspace(0, 1, nb_rate_bins+1)[1:-1])))
+        burst_bin = np.digitize(burst, np.unique(np.quantile(burst, np.linspace(0, 1, nb_burst_bins+1)[1:-1])))
+        strata = rate_bin*(nb_burst_bins+1) + burst_bin
+        self.strata_order = np.argsort(strata, kind='stable')
+        _, self.strata_start, self.strata_count = np.unique(strata[self.strata_order], return_index=True, return_counts=True)
+
+    def __getitem__(self, key):
+        trace, offset = key
+        start = trace*self.trace_length + offset
+        return self.lost[start:start+self.seq_length]
+
+    def get(self, traces, offsets, out=None):
+        """ gathers the sequences at (traces, offsets) as a (n, seq_length) float32 array """
+        index = (np.asarray(traces)*self.trace_length + np.asarray(offsets))[:, None] + np.arange(self.seq_length)
+        if out is None:
+            return self.lost[index].astype('float32')
+        out[...] = self.lost[index]
+        return out
+
+    def sample(self, n, stratified=False, rng=np.random):
+        """ draws n random (traces, offsets) """
+        if stratified:
+            strata = rng.randint(0, len(self.strata_count), size=n)
+            windows = self.strata_order[self.strata_start[strata] + (rng.rand(n)*self.strata_count[strata]).astype('int')]
+        else:
+            windows = rng.randint(0, self.nb_traces*self.nb_windows, size=n)
+        offsets = windows%self.nb_windows*self.seq_length + rng.randint(0, self.seq_length, size=n)
+        return windows//self.nb_windows, offsets
+
+
+class GilbertElliottLossGenerator:
+    """ synthetic losses from a two-state (good/bad) Markov model
+
+        Each sequence gets its own loss rate and mean burst length, drawn uniformly
+        from the given ranges. Packets are lost with probability bad_loss in the bad
+        state and good_loss in the good state (bad_loss=1, good_loss=0 is the simple
+        Gilbert model). It has the same sample()/get() interface as LossTraceBank:
+        sample() only draws a seed per sequence and get() generates the patterns of
+        a whole batch from the seeds of its sequences, so batches are reproducible.
+    """
+    def __init__(self, seq_length, loss_rate=(0., .3), burst_length=(1., 10.), good_loss=0., bad_loss=1.):
+        if not 0 <= good_loss < bad_loss <= 1:
+            raise ValueError("Gilbert-Elliott model needs 0 <= good_loss < bad_loss <= 1")
+        if burst_length[0] < 1:
+            raise ValueError("mean burst length must be at least 1")
+        self.seq_length = seq_length
+        self.loss_rate = loss_rate
+        self.burst_length = burst_length
+        self.good_loss = good_loss
+        self.bad_loss = bad_loss
+
+    def sample(self, n, stratified=False, rng=np.random):
+        # loss conditions are already drawn uniformly, so there is nothing to stratify
+        return rng.randint(0, 2**31, size=n), np.zeros(n, dtype='int')
+
+    def get(self, seeds, offsets=None, out=None):
+        """ generates a (n, seq_length) float32 array of loss patterns """
+        rng = np.random.default_rng(np.asarray(seeds))
+        n = len(seeds)
+        T = self.seq_length
+
+        rate = rng.uniform(self.loss_rate[0], self.loss_rate[1], size=n)
+        # stationary probability of the bad state, and transition probabilities good->bad (p), bad->good (r)
+        bad = np.clip((rate - self.good_loss)/(self.bad_loss - self.good_loss), 0., .999)
+        r = 1./rng.uniform(self.burst_length[0], self.burst_length[1], size=n)
+        # p <= 1 needs bad <= 1/(1 + r): loss rates above that are not reachable with such short bursts,
+        # these sequences get the highest loss rate that is (the good state lasts a single packet)
+        p = np.clip(r*bad/(1 - bad), 1e-9, 1.)
+        start_bad = rng.random(n) < bad
+
+        # alternating run lengths (geometric), until all sequences are covered
+        ends = np.zeros((n, 0), dtype='int64')
+        while ends.shape[1] == 0 or np.any(ends[:, -1] < T):
+            K = int(np.ceil(T/np.min(1/p + 1/r))) + 1
+            good_runs = rng.geometric(p[:, None], size=(n, K))
+            bad_runs = rng.geometric(r[:, None], size=(n, K))
+            runs = np.where(start_bad[:, None, None], np.stack([bad_runs, good_runs], axis=-1), np.stack([good_runs, bad_runs], axis=-1))
+            last = ends[:, -1:] if ends.shape[1] else np.zeros((n, 1), dtype='int64')
+            ends = np.concatenate([ends, last + np.cumsum(np.reshape(runs, (n, -1)), axis=1)], axis=1)
+
+        # the state toggles at the end of each run
+        toggles = np.zeros((n, T), dtype='int32')
+        rows, cols = np.nonzero(ends < T)
+        np.add.at(toggles, (rows, ends[rows, cols]), 1)
+        state_bad = (start_bad[:, None] + np.cumsum(toggles, axis=1)) % 2 == 1
+
+        lost = rng.random((n, T)) < np.where(state_bad, self.bad_loss, self.good_loss)
+        if out is None:
+            out = np.empty((n, T), dtype='float32')
+        np.subtract(1., lost, out=out)
+        return out
@@ -36,6 +36,7 @@ from tensorflow.keras.constraints import Constraint
 from tensorflow.keras.initializers import Initializer
 from tensorflow.keras.callbacks import Callback
 import numpy as np
+import h5py
 
 def quant_regularizer(x):
     Q = 128
@@ -62,6 +63,12 @@ class WeightClip(Constraint):
 
 constraint = WeightClip(0.992)
 
+def plc_sizes(filename):
+    """ GRU and conditioning sizes of the model in a weights file """
+    with h5py.File(filename, "r") as f:
+        weights = f['model_weights'] if 'model_weights' in f else f
+        return min(weights['plc_gru1']['plc_gru1']['recurrent_kernel:0'].shape), weights['plc_dense1']['plc_dense1']['kernel:0'].shape[1]
+
 def new_lpcnet_plc_model(rnn_units=256, nb_used_features=20, nb_burg_features=36, batch_size=128, training=False, adaptation=False, quantize=False, cond_size=128):
     feat = Input(shape=(None, nb_used_features+nb_burg_features), batch_size=batch_size)
     lost = Input(shape=(None, 1), batch_size=batch_size)
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+'''Copyright (c) 2021-2022 Amazon
+
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+""" column-pruned cache of the PLC training features
+
+    The features written by dump_data hold nb_burg_features Burg features, then
+    nb_used_features features, then lpc_order LPC coefficients per frame. PLC training
+    never reads the LPC coefficients, so the cache only keeps the first
+    nb_burg_features + nb_used_features columns, optionally as float16, after a
+    64-byte header describing the layout.
+"""
+
+import struct
+import argparse
+
+import numpy as np
+
+
+CACHE_MAGIC = b'PLCF'
+CACHE_VERSION = 1
+CACHE_HEADER_SIZE = 64
+# magic, version, dtype, nb_frames, nb_burg_features, nb_used_features, lpc_order
+CACHE_HEADER_FORMAT = '<4siiqiii'
+CACHE_DTYPES = {0 : 'float32', 1 : 'float16'}
+
+def is_feature_cache(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(CACHE_MAGIC)) == CACHE_MAGIC
+
+def write_feature_cache(features_file, cache_file, nb_used_features=20, nb_burg_features=36, lpc_order=16, dtype='float32', chunk_frames=100000):
+    """ converts a dump_data feature file into a cache file, in chunks """
+    nb_features = nb_used_features + lpc_order + nb_burg_features
+    nb_columns = nb_burg_features + nb_used_features
+    features = np.memmap(features_file, dtype='float32', mode='r')
+    nb_frames = len(features)//nb_features
+    features = np.reshape(features[:nb_frames*nb_features], (nb_frames, nb_features))
+
+    code = {name : code for code, name in CACHE_DTYPES.items()}[dtype]
+    header = struct.pack(CACHE_HEADER_FORMAT, CACHE_MAGIC, CACHE_VERSION, code, nb_frames, nb_burg_features, nb_used_features, lpc_order)
+    with open(cache_file, 'wb') as f:
+        f.write(header + bytes(CACHE_HEADER_SIZE - len(header)))
+        for start in range(0, nb_frames, chunk_frames):
+            f.write(features[start:start+chunk_frames, :nb_columns].astype(dtype).tobytes())
+    return nb_frames
+
+def open_feature_cache(filename):
+    """ returns a read-only (frames, nb_burg_features + nb_used_features) memmap and the layout """
+    with open(filename, 'rb') as f:
+        header = f.read(struct.calcsize(CACHE_HEADER_FORMAT))
+    magic, version, code, nb_frames, nb_burg_features, nb_used_features, lpc_order = struct.unpack(CACHE_HEADER_FORMAT, header)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION or code not in CACHE_DTYPES:
+        raise ValueError(f"{filename} is not a PLC feature cache (version {CACHE_VERSION})")
+    layout = dict(dtype=CACHE_DTYPES[code], nb_burg_features=nb_burg_features, nb_used_features=nb_used_features, lpc_order=lpc_order)
+    features = np.memmap(filename, dtype=layout['dtype'], mode='r', offset=CACHE_HEADER_SIZE, shape=(nb_frames, nb_burg_features + nb_used_features))
+    return features, layout
+
+def load_plc_features(filename, nb_used_features, nb_burg_features, sequence_size, lpc_order=16, batch_size=1):
+    """ (sequences, sequence_size, nb_burg_features + nb_used_features) view of the features
+        of either a dump_data file or a feature cache, with a multiple of batch_size sequences """
+    if is_feature_cache(filename):
+        features, layout = open_feature_cache(filename)
+        if layout['nb_used_features'] != nb_used_features or layout['nb_burg_features'] != nb_burg_features:
+            raise ValueError(f"{filename} holds {layout['nb_burg_features']} Burg and {layout['nb_used_features']} features, expected {nb_burg_features} and {nb_used_features}")
+        nb_sequences = features.shape[0]//sequence_size//batch_size*batch_size
+        return np.reshape(features[:nb_sequences*sequence_size], (nb_sequences, sequence_size, features.shape[1]))
+    nb_features = nb_used_features + lpc_order + nb_burg_features
+    features = np.memmap(filename, dtype='float32', mode='r')
+    nb_sequences = len(features)//(nb_features*sequence_size)//batch_size*batch_size
+    features = np.reshape(features[:nb_sequences*sequence_size*nb_features], (nb_sequences, sequence_size, nb_features))
+    return features[:, :, :nb_burg_features + nb_used_features]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write the columns of a feature file used for PLC training to a compact cache file')
+    parser.add_argument('features', metavar='<features file>', help='binary features file (float32), as produced by dump_data')
+    parser.add_argument('output', metavar='<cache file>', help='feature cache, can be used as features file by train_plc.py')
+    parser.add_argument('--float16', action='store_true', help='store the features as float16')
+    parser.add_argument('--nb-used-features', metavar='<features>', default=20, type=int, help='number of features (default 20)')
+    parser.add_argument('--nb-burg-features', metavar='<features>', default=36, type=int, help='number of Burg features (default 36)')
+    parser.add_argument('--lpc-order', metavar='<order>', default=16, type=int, help='number of LPC coefficients (default 16)')
+    args = parser.parse_args()
+
+    nb_frames = write_feature_cache(args.features, args.output, nb_used_features=args.nb_used_features, nb_burg_features=args.nb_burg_features,
+                                    lpc_order=args.lpc_order, dtype='float16' if args.float16 else 'float32')
+    print(f"{nb_frames} frames written to {args.output}")
@@ -27,47 +27,76 @@
 
 import numpy as np
 from tensorflow.keras.utils import Sequence
+from tensorflow.keras.callbacks import Callback
+from loss_traces import LossTraceBank
 
 class PLCLoader(Sequence):
-    def __init__(self, features, lost, nb_burg_features, batch_size):
+    def __init__(self, features, lost, nb_burg_features, batch_size, stratified=False, targets_as_inputs=False, chunk_size=None):
         self.batch_size = batch_size
         self.nb_batches = features.shape[0]//self.batch_size
         self.features = features[:self.nb_batches*self.batch_size, :, :]
-        self.lost = lost.astype('float')
-        self.lost = self.lost[:(len(self.lost)//features.shape[1]-1)*features.shape[1]]
+        # lost is either an int8 trace (e.g. a memmap), a LossTraceBank or a GilbertElliottLossGenerator
+        self.lost = lost if hasattr(lost, 'sample') else LossTraceBank(lost, features.shape[1])
+        self.stratified = stratified
+        # for models computing their loss in a layer (see plc_losses.PLCLoss)
+        self.targets_as_inputs = targets_as_inputs
         self.nb_burg_features = nb_burg_features
+        # With chunk_size set (truncated BPTT), each group of batch_size sequences is returned as
+        # nb_chunks consecutive batches of chunk_size frames, so the GRU state can be carried over
+        # from one batch to the next (see ChunkStateReset).
+        self.chunk_size = features.shape[1] if chunk_size is None else chunk_size
+        if features.shape[1] % self.chunk_size != 0:
+            raise ValueError(f"chunk size {self.chunk_size} does not divide the sequence length {features.shape[1]}")
+        self.nb_chunks = features.shape[1]//self.chunk_size
         self.on_epoch_end()
 
     def on_epoch_end(self):
         self.indices = np.arange(self.nb_batches*self.batch_size)
         np.random.shuffle(self.indices)
-        offset = np.random.randint(0, high=self.features.shape[1])
-        self.lost_offset = np.reshape(self.lost[offset:-self.features.shape[1]+offset], (-1, self.features.shape[1]))
-        self.lost_indices = np.random.randint(0, high=self.lost_offset.shape[0], size=self.nb_batches*self.batch_size)
+        self.lost_traces, self.lost_offsets = self.lost.sample(self.nb_batches*self.batch_size, stratified=self.stratified)
 
     def __getitem__(self, index):
-        features = self.features[self.indices[index*self.batch_size:(index+1)*self.batch_size], :, :]
-        burg_lost = (np.random.rand(features.shape[0], features.shape[1]) > .1).astype('float')
-        burg_lost = np.reshape(burg_lost, (features.shape[0], features.shape[1], 1))
-        burg_mask = np.tile(burg_lost, (1,1,self.nb_burg_features))
-
-        lost = self.lost_offset[self.lost_indices[index*self.batch_size:(index+1)*self.batch_size], :]
-        lost = np.reshape(lost, (features.shape[0], features.shape[1], 1))
-        lost_mask = np.tile(lost, (1,1,features.shape[2]))
-        in_features = features*lost_mask
-        in_features[:,:,:self.nb_burg_features] = in_features[:,:,:self.nb_burg_features]*burg_mask
-        
+        # Every batch gets new float32 arrays: Keras (tf.data) may keep references to several
+        # batches without copying them, and batches may be built by several workers at once.
+        group, chunk = divmod(index, self.nb_chunks)
+        batch = slice(group*self.batch_size, (group+1)*self.batch_size)
+        frames = slice(chunk*self.chunk_size, (chunk+1)*self.chunk_size)
+        # a float16 feature cache is converted here
+        features = np.take(self.features[:, frames, :], self.indices[batch], axis=0).astype('float32', copy=False)
+        burg_lost = (np.random.rand(features.shape[0], features.shape[1], 1) > .1).astype('float32')
+
+        # loss patterns are drawn per sequence (get() is deterministic), so all chunks of a group match
+        lost = self.lost.get(self.lost_traces[batch], self.lost_offsets[batch])[:, frames, None]
+        # lost is 0 or 1, so masking the input features once is enough
+        in_features = features*lost
+        in_features[:,:,:self.nb_burg_features] *= burg_lost
+
         #For the first frame after a loss, we don't have valid features, but the Burg estimate is valid.
-        #in_features[:,1:,self.nb_burg_features:] = in_features[:,1:,self.nb_burg_features:]*lost_mask[:,:-1,self.nb_burg_features:]
-        out_lost = np.copy(lost)
-        #out_lost[:,1:,:] = out_lost[:,1:,:]*out_lost[:,:-1,:]
+        #in_features[:,1:,self.nb_burg_features:] = in_features[:,1:,self.nb_burg_features:]*lost[:,:-1,:]
+
+        out_features = np.empty(features.shape[:2] + (features.shape[2]-self.nb_burg_features+1,), dtype='float32')
+        out_features[:,:,:-1] = features[:,:,self.nb_burg_features:]
+        np.subtract(1., lost, out=out_features[:,:,-1:])
 
-        out_features = np.concatenate([features[:,:,self.nb_burg_features:], 1.-out_lost], axis=-1)
-        burg_sign = 2*burg_lost - 1
         # last dim is 1 for received packet, 0 for lost packet, and -1 when just the Burg info is missing
-        inputs = [in_features*lost_mask, lost*burg_sign]
+        lost_sign = lost*(2*burg_lost - 1)
+        inputs = [in_features, lost_sign]
         outputs = [out_features]
+        if self.targets_as_inputs:
+            return (inputs + outputs,)
         return (inputs, outputs)
 
     def __len__(self):
-        return self.nb_batches
+        return self.nb_batches*self.nb_chunks
+
+
+class ChunkStateReset(Callback):
+    """ resets the state of the stateful layers at the first chunk of each group of
+        sequences, for PLCLoader with chunk_size set (training must not shuffle batches) """
+    def __init__(self, nb_chunks):
+        super(ChunkStateReset, self).__init__()
+        self.nb_chunks = nb_chunks
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if batch % self.nb_chunks == 0:
+            self.model.reset_states()
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+'''Copyright (c) 2021-2022 Amazon
+
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+""" losses and metrics of the PLC model, shared by train_plc.py and eval_plc.py """
+
+import tensorflow as tf
+from tensorflow.keras import backend as K
+from tensorflow.keras.layers import Layer
+
+def plc_loss_terms(y_true, y_pred, alpha=1.0, bias=0.):
+    """ computes the error, its IDCT and the pitch terms once and returns all the loss terms """
+    mask = y_true[:,:,-1:]
+    y_true = y_true[:,:,:-1]
+    e = (y_pred - y_true)*mask
+    abs_e = K.abs(e)
+    e_bands = tf.signal.idct(e[:,:,:-2], norm='ortho')
+    abs_bands = K.abs(e_bands)
+    bias_mask = K.minimum(1., K.maximum(0., 4*y_true[:,:,-1:]))
+    pitch_error = abs_e[:,:,18:19]
+    terms = dict(l1=K.mean(abs_e),
+                 ceps=K.mean(abs_e[:,:,:-2]),
+                 band=K.mean(abs_bands),
+                 pitch=K.mean(K.minimum(pitch_error, .4)))
+    terms['loss'] = terms['l1'] + 0.1*K.mean(K.maximum(0., -e[:,:,-1:])) + alpha*(terms['band'] + K.mean(bias*bias_mask*K.maximum(0., e_bands))) + K.mean(K.minimum(pitch_error, 1.)) + 8*terms['pitch']
+    return terms
+
+
+class PLCLoss(Layer):
+    """ adds the PLC loss to the model and its terms as metrics, from a single
+        computation of the terms
+
+        Takes [y_true, y_pred] and returns y_pred, so the targets must be a model input.
+    """
+    metric_names = {'l1' : 'L1_loss', 'ceps' : 'ceps_loss', 'band' : 'L1_band_loss', 'pitch' : 'pitch_loss'}
+
+    def __init__(self, alpha=1.0, bias=0., **kwargs):
+        super(PLCLoss, self).__init__(**kwargs)
+        self.alpha = alpha
+        self.bias = bias
+
+    def call(self, inputs):
+        y_true, y_pred = inputs
+        terms = plc_loss_terms(y_true, y_pred, self.alpha, self.bias)
+        self.add_loss(terms['loss'])
+        for key, name in self.metric_names.items():
+            self.add_metric(terms[key], name=name)
+        return y_pred
+
+    def get_config(self):
+        config = super(PLCLoss, self).get_config()
+        config.update({'alpha': self.alpha, 'bias': self.bias})
+        return config
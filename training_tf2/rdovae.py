@@ -155,36 +155,27 @@ def sq_rate_metric(y_true,y_pred, reduce=True):
     return rate
 
 def pvq_quant_search(x, k):
-    x = x/tf.reduce_sum(tf.abs(x), axis=-1, keepdims=True)
-    kx = k*x
-    y = tf.round(kx)
-    newk = k
-
-    for j in range(10):
-        #print("y = ", y)
-        #print("iteration ", j)
-        abs_y = tf.abs(y)
-        abs_kx = tf.abs(kx)
-        kk=tf.reduce_sum(abs_y, axis=-1)
-        #print("sums = ", kk)
-        plus = 1.000001*tf.reduce_min((abs_y+.5)/(abs_kx+1e-15), axis=-1)
-        minus = .999999*tf.reduce_max((abs_y-.5)/(abs_kx+1e-15), axis=-1)
-        #print("plus = ", plus)
-        #print("minus = ", minus)
-        factor = tf.where(kk>k, minus, plus)
-        factor = tf.where(kk==k, tf.ones_like(factor), factor)
-        #print("scale = ", factor)
-        factor = tf.expand_dims(factor, axis=-1)
-        #newk = newk * (k/kk)**.2
-        newk = newk*factor
-        kx = newk*x
-        #print("newk = ", newk)
-        #print("unquantized = ", newk*x)
-        y = tf.round(kx)
-
-    #print(y)
-    #print(K.mean(K.sum(K.abs(y), axis=-1)))
-    return y
+    """ integer vector y with sum(|y|) = k closest in angle to x: projection on the
+        pyramid (rounded down), then the remaining pulses (fewer than the dimension)
+        placed greedily where they increase the correlation the most """
+    n = x.shape[-1]
+    abs_x = tf.abs(x)
+    # all pulses of zero vectors go to the first position
+    abs_x = abs_x + tf.cast(tf.equal(tf.reduce_sum(abs_x, axis=-1, keepdims=True), 0.), x.dtype)*tf.one_hot(0, n, dtype=x.dtype)
+    l1 = tf.reduce_sum(abs_x, axis=-1, keepdims=True)
+    # slightly shrunk so that rounding errors never give more than k pulses
+    y = tf.floor(k*(1 - 1e-6)*abs_x/l1)
+    remaining = k - tf.reduce_sum(y, axis=-1, keepdims=True)
+
+    for j in range(n):
+        xy = tf.reduce_sum(abs_x*y, axis=-1, keepdims=True)
+        yy = tf.reduce_sum(y*y, axis=-1, keepdims=True)
+        score = (xy + abs_x)**2/(yy + 2*y + 1)
+        pulse = tf.one_hot(tf.argmax(score, axis=-1), n, dtype=x.dtype)*tf.cast(remaining > 0, x.dtype)
+        y = y + pulse
+        remaining = remaining - tf.reduce_sum(pulse, axis=-1, keepdims=True)
+
+    return tf.where(x < 0, -y, y)
 
 def pvq_quantize(x, k):
     x = x/(1e-15+tf.norm(x, axis=-1,keepdims=True))
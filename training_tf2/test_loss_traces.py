@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+'''Copyright (c) 2021-2022 Amazon
+
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+""" unit tests of loss_traces.py (python -m pytest test_loss_traces.py) """
+
+import numpy as np
+
+from loss_traces import GilbertElliottLossGenerator, loss_statistics
+
+
+def test_gilbert_elliott_high_loss_short_bursts():
+    # loss rates above 1/(1 + 1/burst_length) are infeasible and must be clipped, not raise
+    generator = GilbertElliottLossGenerator(1000, loss_rate=(0., .7), burst_length=(1., 3.))
+    for seed in range(20):
+        seeds, offsets = generator.sample(64, rng=np.random.RandomState(seed))
+        lost = generator.get(seeds, offsets)
+        assert lost.shape == (64, 1000)
+        assert lost.dtype == np.float32
+        assert np.all((lost == 0) | (lost == 1))
+
+def test_gilbert_elliott_loss_rate():
+    generator = GilbertElliottLossGenerator(20000, loss_rate=(.2, .2), burst_length=(4., 4.))
+    seeds, offsets = generator.sample(16, rng=np.random.RandomState(0))
+    rate, burst = loss_statistics(generator.get(seeds, offsets))
+    assert np.all(np.abs(rate - .2) < .03)
+    assert np.all(np.abs(burst - 4.) < .6)
@@ -26,22 +26,20 @@
    SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
-# Train an LPCNet model
+# Run a PLC model frame by frame on a feature file
 
 import argparse
-from plc_loader import PLCLoader
 
 parser = argparse.ArgumentParser(description='Test a PLC model')
 
 parser.add_argument('weights', metavar='<weights file>', help='weights file (.h5)')
-parser.add_argument('features', metavar='<features file>', help='binary features file (float32)')
-parser.add_argument('output', metavar='<output>', help='reconstructed file (float32)')
+parser.add_argument('features', metavar='<features file>', help='binary features file (float32), as produced by dump_data')
+parser.add_argument('output', metavar='<output>', help='reconstructed features file (float32)')
 parser.add_argument('--model', metavar='<model>', default='lpcnet_plc', help='PLC model python definition (without .py)')
-group1 = parser.add_mutually_exclusive_group()
-
-parser.add_argument('--gru-size', metavar='<units>', default=256, type=int, help='number of units in GRU (default 256)')
-parser.add_argument('--cond-size', metavar='<units>', default=128, type=int, help='number of units in conditioning network (default 128)')
-
+parser.add_argument('--lost-file', metavar='<packet loss file>', help='packet loss trace (int8, 1 for received, 0 for lost), default: no loss')
+parser.add_argument('--lost-offset', metavar='<offset>', default=0, type=int, help='first packet of the loss trace to use (default 0)')
+parser.add_argument('--compare', nargs=2, metavar=('<weights file>', '<output>'), action='append', default=[], help='also run another PLC model (sizes read from its weights file) on the same inputs, can be repeated')
+parser.add_argument('--latency-file', metavar='<latency file>', help='also write the processing time of each frame in seconds (float32)')
 
 args = parser.parse_args()
 
@@ -49,44 +47,79 @@ import importlib
 lpcnet = importlib.import_module(args.model)
 
 import sys
+import time
 import numpy as np
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import ModelCheckpoint, CSVLogger
-import tensorflow.keras.backend as K
-import h5py
 
 import tensorflow as tf
-#gpus = tf.config.experimental.list_physical_devices('GPU')
-#if gpus:
-#  try:
-#    tf.config.experimental.set_virtual_device_configuration(gpus[0], [tf.config.experimental.VirtualDeviceConfiguration(memory_limit=5120)])
-#  except RuntimeError as e:
-#    print(e)
+from lpcnet_plc import plc_sizes
+
+def load_model(filename, rnn_units, cond_size):
+    model = lpcnet.new_lpcnet_plc_model(rnn_units=rnn_units, batch_size=1, training=False, quantize=False, cond_size=cond_size)
+    model.compile()
+    model.load_weights(filename)
+    return model
 
-model = lpcnet.new_lpcnet_plc_model(rnn_units=args.gru_size, batch_size=1, training=False, quantize=False, cond_size=args.cond_size)
-model.compile()
+# all models are built with the sizes found in their weights file
+models = [load_model(weights, *plc_sizes(weights)) for weights in [args.weights] + [weights for weights, _ in args.compare]]
+model = models[0]
+output_files = [args.output] + [output for _, output in args.compare]
 
 lpc_order = 16
+frame_size = 0.01
 
-feature_file = args.features
-nb_features = model.nb_used_features + lpc_order
 nb_used_features = model.nb_used_features
-
-# u for unquantised, load 16 bit PCM samples and convert to mu-law
-
-features = np.loadtxt(feature_file)
-print(features.shape)
-sequence_size = features.shape[0]
-lost = np.reshape(features[:,-1:], (1, sequence_size, 1))
-features = features[:,:nb_used_features]
-features = np.reshape(features, (1, sequence_size, nb_used_features))
-
-
-model.load_weights(args.weights)
-
-features = features*lost
-out = model.predict([features, lost])
-
-out = features + (1-lost)*out
-
-np.savetxt(args.output, out[0,:,:])
+nb_burg_features = model.nb_burg_features
+nb_features = nb_used_features + lpc_order + nb_burg_features
+
+# features are only read when needed, so long recordings use bounded memory
+features = np.memmap(args.features, dtype='float32', mode='r')
+features = np.reshape(features[:len(features)//nb_features*nb_features], (-1, nb_features))
+nb_frames = features.shape[0]
+
+if args.lost_file is not None:
+    lost = np.memmap(args.lost_file, dtype='int8', mode='r')[args.lost_offset:]
+    if len(lost) < nb_frames:
+        print("loss trace shorter than the features, the remaining packets are received", file=sys.stderr)
+else:
+    lost = np.ones(0, dtype='int8')
+
+# The GRUs are stateful, so each call continues from the state left by the previous
+# frame, like compute_plc_pred() in lpcnet_plc.c. All the models run on the same
+# inputs in a single graph call.
+@tf.function
+def plc_step(feat, lost):
+    return [m([feat, lost], training=False) for m in models]
+
+in_features = np.zeros((1, 1, nb_used_features + nb_burg_features), dtype='float32')
+in_lost = np.zeros((1, 1, 1), dtype='float32')
+
+# trace plc_step before the first frame, so the latency only covers the processing
+plc_step(in_features, in_lost)
+for m in models:
+    m.reset_states()
+latency = np.zeros(nb_frames, dtype='float32')
+fouts = [open(filename, 'wb') for filename in output_files]
+try:
+    for i in range(nb_frames):
+        received = lost[i] if i < len(lost) else 1
+        frame = features[i, :nb_used_features + nb_burg_features]
+        in_features[0, 0, :] = frame if received else 0.
+        in_lost[0, 0, 0] = received
+
+        start = time.perf_counter()
+        preds = [pred.numpy() for pred in plc_step(in_features, in_lost)]
+        latency[i] = time.perf_counter() - start
+
+        for pred, fout in zip(preds, fouts):
+            out = frame[nb_burg_features:] if received else pred[0, 0, :]
+            out.astype('float32').tofile(fout)
+finally:
+    for fout in fouts:
+        fout.close()
+
+if args.latency_file is not None:
+    latency.tofile(args.latency_file)
+
+if nb_frames > 0:
+    print("{} frames, latency: mean {:.3f} ms, median {:.3f} ms, 99th percentile {:.3f} ms, max {:.3f} ms, real-time factor {:.3f}".format(
+          nb_frames, 1000*np.mean(latency), 1000*np.median(latency), 1000*np.percentile(latency, 99), 1000*np.max(latency), np.sum(latency)/(nb_frames*frame_size)))
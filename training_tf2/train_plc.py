@@ -29,12 +29,15 @@
 # Train an LPCNet model
 
 import argparse
-from plc_loader import PLCLoader
+from plc_loader import PLCLoader, ChunkStateReset
+from plc_losses import PLCLoss
+from loss_traces import GilbertElliottLossGenerator
+from plc_feature_cache import load_plc_features
 
 parser = argparse.ArgumentParser(description='Train a PLC model')
 
-parser.add_argument('features', metavar='<features file>', help='binary features file (float32)')
-parser.add_argument('lost_file', metavar='<packet loss file>', help='packet loss traces (int8)')
+parser.add_argument('features', metavar='<features file>', help='binary features file (float32), or a cache written by plc_feature_cache.py')
+parser.add_argument('lost_file', metavar='<packet loss file>', help='packet loss traces (int8), not read with --synthetic-loss')
 parser.add_argument('output', metavar='<output>', help='trained model file (.h5)')
 parser.add_argument('--model', metavar='<model>', default='lpcnet_plc', help='PLC model python definition (without .py)')
 group1 = parser.add_mutually_exclusive_group()
@@ -45,10 +48,15 @@ parser.add_argument('--cond-size', metavar='<units>', default=128, type=int, hel
 parser.add_argument('--epochs', metavar='<epochs>', default=120, type=int, help='number of epochs to train for (default 120)')
 parser.add_argument('--batch-size', metavar='<batch size>', default=128, type=int, help='batch size to use (default 128)')
 parser.add_argument('--seq-length', metavar='<sequence length>', default=1000, type=int, help='sequence length to use (default 1000)')
+parser.add_argument('--tbptt', metavar='<frames>', type=int, help='truncated backpropagation through time: split sequences into chunks of this length, carrying the GRU state between batches (must divide the sequence length)')
 parser.add_argument('--lr', metavar='<learning rate>', type=float, help='learning rate')
 parser.add_argument('--decay', metavar='<decay>', type=float, help='learning rate decay')
 parser.add_argument('--band-loss', metavar='<weight>', default=1.0, type=float, help='weight of band loss (default 1.0)')
 parser.add_argument('--loss-bias', metavar='<bias>', default=0.0, type=float, help='loss bias towards low energy (default 0.0)')
+parser.add_argument('--synthetic-loss', action='store_true', help='generate Gilbert-Elliott losses instead of reading the packet loss file')
+parser.add_argument('--loss-rate', nargs=2, metavar=('<min>', '<max>'), default=(0., .3), type=float, help='range of synthetic loss rates (default 0 0.3)')
+parser.add_argument('--burst-length', nargs=2, metavar=('<min>', '<max>'), default=(1., 10.), type=float, help='range of synthetic mean burst lengths in packets (default 1 10)')
+parser.add_argument('--stratify-loss', action='store_true', help='sample loss patterns uniformly over loss rate and burst length bins')
 parser.add_argument('--logdir', metavar='<log dir>', help='directory for tensorboard log files')
 
 
@@ -60,6 +68,8 @@ lpcnet = importlib.import_module(args.model)
 import sys
 import numpy as np
 from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Input
 from tensorflow.keras.callbacks import ModelCheckpoint, CSVLogger
 import tensorflow.keras.backend as K
 import h5py
@@ -97,60 +107,16 @@ if args.decay is not None:
 if retrain:
     input_model = args.retrain
 
-def plc_loss(alpha=1.0, bias=0.):
-    def loss(y_true,y_pred):
-        mask = y_true[:,:,-1:]
-        y_true = y_true[:,:,:-1]
-        e = (y_pred - y_true)*mask
-        e_bands = tf.signal.idct(e[:,:,:-2], norm='ortho')
-        bias_mask = K.minimum(1., K.maximum(0., 4*y_true[:,:,-1:]))
-        l1_loss = K.mean(K.abs(e)) + 0.1*K.mean(K.maximum(0., -e[:,:,-1:])) + alpha*K.mean(K.abs(e_bands) + bias*bias_mask*K.maximum(0., e_bands)) + K.mean(K.minimum(K.abs(e[:,:,18:19]),1.)) + 8*K.mean(K.minimum(K.abs(e[:,:,18:19]),.4))
-        return l1_loss
-    return loss
-
-def plc_l1_loss():
-    def L1_loss(y_true,y_pred):
-        mask = y_true[:,:,-1:]
-        y_true = y_true[:,:,:-1]
-        e = (y_pred - y_true)*mask
-        l1_loss = K.mean(K.abs(e))
-        return l1_loss
-    return L1_loss
-
-def plc_ceps_loss():
-    def ceps_loss(y_true,y_pred):
-        mask = y_true[:,:,-1:]
-        y_true = y_true[:,:,:-1]
-        e = (y_pred - y_true)*mask
-        l1_loss = K.mean(K.abs(e[:,:,:-2]))
-        return l1_loss
-    return ceps_loss
-
-def plc_band_loss():
-    def L1_band_loss(y_true,y_pred):
-        mask = y_true[:,:,-1:]
-        y_true = y_true[:,:,:-1]
-        e = (y_pred - y_true)*mask
-        e_bands = tf.signal.idct(e[:,:,:-2], norm='ortho')
-        l1_loss = K.mean(K.abs(e_bands))
-        return l1_loss
-    return L1_band_loss
-
-def plc_pitch_loss():
-    def pitch_loss(y_true,y_pred):
-        mask = y_true[:,:,-1:]
-        y_true = y_true[:,:,:-1]
-        e = (y_pred - y_true)*mask
-        l1_loss = K.mean(K.minimum(K.abs(e[:,:,18:19]),.4))
-        return l1_loss
-    return pitch_loss
-
 opt = Adam(lr, decay=decay, beta_2=0.99)
 strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
 
 with strategy.scope():
     model = lpcnet.new_lpcnet_plc_model(rnn_units=args.gru_size, batch_size=batch_size, training=True, quantize=quantize, cond_size=args.cond_size)
-    model.compile(optimizer=opt, loss=plc_loss(alpha=args.band_loss, bias=args.loss_bias), metrics=[plc_l1_loss(), plc_ceps_loss(), plc_band_loss(), plc_pitch_loss()])
+    # the targets are an input of the training model so the loss and its metrics are computed
+    # once per step by the PLCLoss layer (the extra layers have no weights)
+    y_true = Input(shape=(None, model.nb_used_features+1), batch_size=batch_size)
+    train_model = Model(model.inputs + [y_true], PLCLoss(alpha=args.band_loss, bias=args.loss_bias, name='plc_loss')([y_true, model.output]))
+    train_model.compile(optimizer=opt)
     model.summary()
 
 lpc_order = 16
@@ -164,15 +130,13 @@ sequence_size = args.seq_length
 # u for unquantised, load 16 bit PCM samples and convert to mu-law
 
 
-features = np.memmap(feature_file, dtype='float32', mode='r')
-nb_sequences = len(features)//(nb_features*sequence_size)//batch_size*batch_size
-features = features[:nb_sequences*sequence_size*nb_features]
-
-features = np.reshape(features, (nb_sequences, sequence_size, nb_features))
+# either the dump_data features or a cache written by plc_feature_cache.py
+features = load_plc_features(feature_file, nb_used_features, nb_burg_features, sequence_size, lpc_order=lpc_order, batch_size=batch_size)
 
-features = features[:, :, :nb_used_features+model.nb_burg_features]
-
-lost = np.memmap(args.lost_file, dtype='int8', mode='r')
+if args.synthetic_loss:
+    lost = GilbertElliottLossGenerator(sequence_size, loss_rate=args.loss_rate, burst_length=args.burst_length)
+else:
+    lost = np.memmap(args.lost_file, dtype='int8', mode='r')
 
 # dump models to disk as we go
 checkpoint = ModelCheckpoint('{}_{}_{}.h5'.format(args.output, args.gru_size, '{epoch:02d}'))
@@ -186,12 +150,15 @@ if quantize or retrain:
 
 model.save_weights('{}_{}_initial.h5'.format(args.output, args.gru_size))
 
-loader = PLCLoader(features, lost, nb_burg_features, batch_size)
+loader = PLCLoader(features, lost, nb_burg_features, batch_size, stratified=args.stratify_loss, targets_as_inputs=True, chunk_size=args.tbptt)
 
 callbacks = [checkpoint]
+if args.tbptt is not None:
+    callbacks.append(ChunkStateReset(loader.nb_chunks))
 if args.logdir is not None:
     logdir = '{}/{}_{}_logs'.format(args.logdir, args.output, args.gru_size)
     tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=logdir)
     callbacks.append(tensorboard_callback)
 
-model.fit(loader, epochs=nb_epochs, validation_split=0.0, callbacks=callbacks)
+# chunks of the same sequences must be seen in order with --tbptt
+train_model.fit(loader, epochs=nb_epochs, validation_split=0.0, callbacks=callbacks, shuffle=args.tbptt is None)
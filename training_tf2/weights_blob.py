@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+'''Copyright (c) 2023 Amazon
+
+   Redistribution and use in source and binary forms, with or without
+   modification, are permitted provided that the following conditions
+   are met:
+
+   - Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+   - Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+   ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+   LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+   A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+   CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+   EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+   PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+   LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+   NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+""" reader for the binary weights blob (weights_blob.bin) parsed by parse_lpcnet_weights.c
+
+    The blob is memory-mapped and each record becomes a read-only numpy view, so
+    even very large files are inspected without being copied. Blobs can be
+    compared with each other, with a Keras .h5 model (LPCNet or PLC) or with an
+    RDOVAE torch checkpoint.
+"""
+
+import os
+import sys
+import mmap
+import struct
+import argparse
+
+import numpy as np
+
+from keraslayerdump import WEIGHT_TYPES, WEIGHT_BLOCK_SIZE, WEIGHT_BLOB_VERSION, WEIGHT_HEAD_FORMAT
+
+
+WEIGHT_TYPE_NAMES = {value : key for key, value in WEIGHT_TYPES.items()}
+
+
+class BlobArray:
+    """ one record of the blob, data is a view into the mapped file """
+    def __init__(self, name, type, size, offset, data):
+        self.name = name
+        self.type = type
+        self.size = size
+        self.offset = offset
+        self.data = data
+
+    @property
+    def type_name(self):
+        return WEIGHT_TYPE_NAMES.get(self.type, str(self.type))
+
+
+def parse_record(data, offset, dotp=True):
+    """ parses the record at offset, with the same checks as parse_record() in C
+
+        returns the array and the offset of the next record
+    """
+    remaining = len(data) - offset
+    if remaining < WEIGHT_BLOCK_SIZE:
+        raise ValueError(f"parse_record: truncated header at offset {offset}")
+    head, version, type, size, block_size, name = struct.unpack_from(WEIGHT_HEAD_FORMAT, data, offset)
+    if head != b'DNNw' or version != WEIGHT_BLOB_VERSION:
+        raise ValueError(f"parse_record: bad header {head} (version {version}) at offset {offset}")
+    if block_size < size:
+        raise ValueError(f"parse_record: block size {block_size} smaller than size {size} at offset {offset}")
+    if block_size > remaining - WEIGHT_BLOCK_SIZE:
+        raise ValueError(f"parse_record: block size {block_size} exceeds the end of the blob at offset {offset}")
+    if name[-1] != 0:
+        raise ValueError(f"parse_record: unterminated name at offset {offset}")
+    if size <= 0:
+        raise ValueError(f"parse_record: invalid size {size} at offset {offset}")
+
+    name = name[:name.index(0)].decode()
+    start = offset + WEIGHT_BLOCK_SIZE
+    type_name = WEIGHT_TYPE_NAMES.get(type)
+    if type_name == 'float' or (type_name == 'qweight' and not dotp):
+        dtype = np.dtype('<f4')
+    elif type_name == 'int':
+        dtype = np.dtype('<i4')
+    elif type_name == 'qweight':
+        dtype = np.dtype('int8')
+    else:
+        dtype = np.dtype('uint8')
+    if size % dtype.itemsize:
+        raise ValueError(f"parse_record: size {size} of {name} is not a multiple of {dtype.itemsize}")
+    view = np.frombuffer(data, dtype=dtype, count=size // dtype.itemsize, offset=start)
+
+    return BlobArray(name, type, size, offset, view), start + block_size
+
+
+class WeightBlob:
+    """ memory-mapped weights blob
+
+        dotp selects how qweight arrays are interpreted (int8 for a DOT_PROD build,
+        float otherwise), since the blob itself does not record it.
+    """
+    def __init__(self, filename, dotp=True):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+        self.arrays = dict()
+        offset = 0
+        while offset < len(self.data):
+            array, offset = parse_record(self.data, offset, dotp=dotp)
+            if array.name in self.arrays:
+                print(f"warning: duplicate array {array.name} in {filename}, using the first one", file=sys.stderr)
+                continue
+            self.arrays[array.name] = array
+
+    def __getitem__(self, name):
+        return self.arrays[name].data
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def close(self):
+        """ the arrays are views of the mapping, copy the ones still needed after close()
+
+            If views are still referenced, the mapping is left to the garbage collector.
+        """
+        self.arrays = dict()
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                pass
+        self.file.close()
+
+
+def compare_arrays(arrays, reference):
+    """ compares two dicts name -> (type name, array), returns a list of
+        (name, status, max abs error) for all names in either dict """
+    results = []
+    for name in list(arrays) + [name for name in reference if name not in arrays]:
+        if name not in reference:
+            results.append((name, 'extra', None))
+            continue
+        if name not in arrays:
+            results.append((name, 'missing', None))
+            continue
+        (type_a, a), (type_b, b) = arrays[name], reference[name]
+        if type_a != type_b:
+            results.append((name, f'type {type_a} != {type_b}', None))
+        elif a.shape != b.shape:
+            results.append((name, f'size {a.size} != {b.size}', None))
+        elif a.dtype == b.dtype and np.array_equal(a, b):
+            results.append((name, 'ok', 0.))
+        else:
+            error = float(np.max(np.abs(a.astype('float64') - b.astype('float64')))) if a.size > 0 else 0.
+            results.append((name, 'ok' if error == 0 else 'differs', error))
+    return results
+
+def blob_arrays(blob):
+    return {name : (array.type_name, array.data) for name, array in blob.arrays.items()}
+
+def exported_arrays(layers, dotp=True):
+    """ arrays of a list of keraslayerdump.ExportedLayer, as they would be written to a blob """
+    arrays = dict()
+    for layer in layers:
+        for array in layer.arrays:
+            dtype, data = array.variant(dotp)
+            if dtype == 'qweight':
+                data = data.astype('int8') if dotp else data.astype('float32')
+            else:
+                data = data.astype('int32' if dtype == 'int' else 'float32')
+            arrays[array.name] = (dtype, data)
+    return arrays
+
+
+def h5_layers(filename, model_type):
+    """ exported layers of a Keras model, using the same code as dump_lpcnet.py/dump_plc.py """
+    from keraslayerdump import LayerExporter
+    exporter = LayerExporter([])
+    if model_type == 'lpcnet':
+        from dump_lpcnet import load_lpcnet_model, add_lpcnet_layers
+        model, _ = load_lpcnet_model(filename)
+        add_lpcnet_layers(exporter, model)
+    else:
+        from dump_plc import load_plc_model
+        exporter.add_model(load_plc_model(filename))
+    return exporter.layers
+
+
+def linear(x):
+    return x
+
+class _TorchLayer:
+    """ minimal stand-in for a Keras layer, built from torch weights (the activation
+        only ends up in the generated C code, so it is not looked up) """
+    def __init__(self, name, weights):
+        self.name = name
+        self.weights = weights
+        self.activation = linear
+
+    def get_weights(self):
+        return [np.copy(w) for w in self.weights]
+
+# (torch module, exported name) for the RDOVAE, as in torch/rdovae/export_rdovae_weights.py
+rdovae_torch_layers = [
+    ('core_encoder.dense_1', 'enc_dense1'),
+    ('core_encoder.dense_2', 'enc_dense3'),
+    ('core_encoder.dense_3', 'enc_dense5'),
+    ('core_encoder.dense_4', 'enc_dense7'),
+    ('core_encoder.dense_5', 'enc_dense8'),
+    ('core_encoder.state_dense_1', 'gdense1'),
+    ('core_encoder.state_dense_2', 'gdense2'),
+    ('core_encoder.gru_1', 'enc_dense2'),
+    ('core_encoder.gru_2', 'enc_dense4'),
+    ('core_encoder.gru_3', 'enc_dense6'),
+    ('core_encoder.conv1', 'bits_dense'),
+    ('core_decoder.gru_1_init', 'state1'),
+    ('core_decoder.gru_2_init', 'state2'),
+    ('core_decoder.gru_3_init', 'state3'),
+    ('core_decoder.dense_1', 'dec_dense1'),
+    ('core_decoder.dense_2', 'dec_dense3'),
+    ('core_decoder.dense_3', 'dec_dense5'),
+    ('core_decoder.dense_4', 'dec_dense7'),
+    ('core_decoder.dense_5', 'dec_dense8'),
+    ('core_decoder.output', 'dec_final'),
+    ('core_decoder.gru_1', 'dec_dense2'),
+    ('core_decoder.gru_2', 'dec_dense4'),
+    ('core_decoder.gru_3', 'dec_dense6')
+]
+
+def torch_layers(filename):
+    """ exported layers of an RDOVAE torch checkpoint, converted to the Keras weight layout """
+    import torch
+    from keraslayerdump import dump_dense_layer, dump_conv1d_layer, gru_layer
+
+    checkpoint = torch.load(filename, map_location='cpu')
+    # parameter names do not depend on the (DataParallel) wrapper
+    state_dict = {key.replace('.module.', '.') : value.numpy() for key, value in checkpoint['state_dict'].items()}
+
+    def zrn(x):
+        # torch uses r, z, n gate order, Keras z, r, h
+        N = x.shape[0] // 3
+        return np.concatenate([x[N:2*N], x[:N], x[2*N:]])
+
+    layers = []
+    for module, name in rdovae_torch_layers:
+        if module + '.weight_ih_l0' in state_dict:
+            w = [zrn(state_dict[module + suffix]) for suffix in ['.weight_ih_l0', '.weight_hh_l0', '.bias_ih_l0', '.bias_hh_l0']]
+            layers.append(gru_layer(_TorchLayer(name, [w[0].T, w[1].T, np.stack([w[2], w[3]])])))
+        elif state_dict[module + '.weight'].ndim == 3:
+            layers.append(dump_conv1d_layer(_TorchLayer(name, [np.transpose(state_dict[module + '.weight'], (2, 1, 0)), state_dict[module + '.bias']])))
+        else:
+            layers.append(dump_dense_layer(_TorchLayer(name, [state_dict[module + '.weight'].T, state_dict[module + '.bias']])))
+    return layers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check a binary weights blob and compare it with another blob or model')
+    parser.add_argument('blob', type=str, help='weights blob (e.g. weights_blob.bin)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--diff', type=str, help='compare with another weights blob', default=None)
+    group.add_argument('--h5', type=str, help='compare with a Keras model (.h5)', default=None)
+    group.add_argument('--torch', type=str, help='compare with an RDOVAE torch checkpoint (.pth)', default=None)
+    parser.add_argument('--model', choices=['lpcnet', 'plc'], help='type of the Keras model, default: lpcnet', default='lpcnet')
+    parser.add_argument('--no-dot-product', action='store_true', help='blob is for a library built with --disable-dot-product')
+    parser.add_argument('--tolerance', type=float, help='maximum absolute error accepted, default: 0', default=0.)
+    parser.add_argument('--verbose', action='store_true', help='list all arrays, not only the ones that differ')
+
+    args = parser.parse_args()
+    dotp = not args.no_dot_product
+
+    blob = WeightBlob(args.blob, dotp=dotp)
+    print(f"{args.blob}: {len(blob)} arrays, {len(blob.data)} bytes")
+
+    if args.diff is not None:
+        reference = blob_arrays(WeightBlob(args.diff, dotp=dotp))
+    elif args.h5 is not None:
+        # only the arrays of the Keras model are checked, a blob can contain several models
+        reference = exported_arrays(h5_layers(args.h5, args.model), dotp=dotp)
+    elif args.torch is not None:
+        reference = exported_arrays(torch_layers(args.torch), dotp=dotp)
+    else:
+        reference = None
+
+    if reference is None:
+        for name, array in blob.arrays.items():
+            print(f"{name:44s} {array.type_name:8s} {array.size:10d}")
+        sys.exit(0)
+
+    arrays = blob_arrays(blob)
+    if args.h5 is not None or args.torch is not None:
+        arrays = {name : value for name, value in arrays.items() if name in reference}
+
+    failed = 0
+    for name, status, error in compare_arrays(arrays, reference):
+        bad = status not in ('ok', 'differs') or error > args.tolerance
+        failed += bad
+        if bad or args.verbose:
+            print(f"{name:44s} {status:12s} {'' if error is None else error}")
+
+    print(f"{failed} array(s) differ")
+    sys.exit(1 if failed else 0)